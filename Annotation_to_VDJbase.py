@@ -1,75 +1,592 @@
 import os
 import shutil
 import json
-import pandas as pd
+import csv
 import argparse
-import subprocess
 import sys
 import datetime
 import time
+import hashlib
+import re
+import threading
+import contextlib
+import copy
+import sqlite3
+from collections import namedtuple
 
 REQUIRED_FILES = ['haplotype', 'genotype.tsv', 'ogrdb_plots.pdf', 'ogrdb_report.csv']
 SPLIT = '/'
 #SPLIT= '\\'
+# Upper bound on the bytes being copied at the same time by the parallel transfer
+MAX_IN_FLIGHT_BYTES = 512 * 1024 * 1024
+# Seconds between updates of the progress line of the parallel transfer on a terminal
+PROGRESS_INTERVAL = 1.0
+# How copy_file places a file in the target repo, see place_file
+LINK_MODES = ['copy', 'hardlink', 'reflink', 'symlink', 'auto']
+# Linux ioctl request that clones a file on copy-on-write filesystems (btrfs, XFS)
+FICLONE = 0x40049409
+# Sidecar file, kept in every samples/<project_number> folder, that records what an incremental sync placed there
+SYNC_MANIFEST_NAME = '.vdjbase_sync.json'
+
+# Content-addressed store, kept in the target repo folder, of the files placed with dedup, see dedup_copy_plan
+OBJECT_STORE_NAME = '.vdjbase_objects'
+
+# Bump when the merge logic changes, so recorded merge states are not reused across versions
+MERGE_STATE_VERSION = 1
+# Scan cache file kept in the source folder, see open_scan_cache
+SCAN_CACHE_NAME = '.vdjbase_scan_cache.sqlite'
+# Encoders write_json can use; orjson is optional and much faster but only indents by two spaces
+JSON_BACKENDS = ['json', 'orjson']
+# Columns each kind of TSV result must have, matched on the file name in this order (haplotype tables are named <repertoire>_haplotype_Finale_<gene>.tsv)
+TSV_SCHEMAS = [
+    ('haplotype', ('gene',)),
+    ('genotype.tsv', ('gene', 'alleles', 'counts')),
+    ('Finale', ('sequence_id', 'productive', 'v_call', 'j_call'))
+]
+# Size of the chunks validate_tsv reads
+VALIDATION_CHUNK_SIZE = 1024 * 1024
+
+# A sub-folder returned by list_directory
+FolderEntry = namedtuple('FolderEntry', ['name', 'path'])
+# One row of airr_correspondence.csv
+CorrespondenceRow = namedtuple('CorrespondenceRow', ['airr_file', 'vdjbase_name', 'airr_repertoire_id'])
+# A repertoire of the project in airr_correspondence.csv, see derive_vdjbase_project_mapping
+VdjbaseRepertoire = namedtuple('VdjbaseRepertoire', ['project_name', 'vdjbase_name', 'project_number', 'individual', 'sample', 'airr_repertoire_id'])
+# airr_correspondence.csv files already loaded by this process, absolute path -> ((mtime_ns, size), correspondence)
+_correspondence_cache = {}
+# TSV result files this process found valid, path -> ((mtime_ns, size), result), see validate_result_files
+_validation_cache = {}
+
+# Wall time per stage, counters and broken result files of the current run, see reset_run_stats and write_run_report
+_run_stats = {'stages': {}, 'counters': {}, 'broken_files': []}
+_run_stats_lock = threading.Lock()
+# Scan cache used by list_directory and read_cached_json during the current run, see use_scan_cache
+_active_scan_cache = None
+
+
+def reset_run_stats():
+    global _run_stats
+    with _run_stats_lock:
+        _run_stats = {'stages': {}, 'counters': {}, 'broken_files': []}
+
+# Returns a copy of the stage timings, counters and broken result files recorded since the last reset
+def get_run_stats():
+    with _run_stats_lock:
+        return {'stages': dict(_run_stats['stages']), 'counters': dict(_run_stats['counters']), 'broken_files': list(_run_stats['broken_files'])}
+
+# Adds amount to a run counter; safe to call from the transfer threads
+def count(name, amount=1):
+    with _run_stats_lock:
+        _run_stats['counters'][name] = _run_stats['counters'].get(name, 0) + amount
+
+# Adds the wall time of the enclosed block to a stage of the run report
+@contextlib.contextmanager
+def timed_stage(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        with _run_stats_lock:
+            _run_stats['stages'][name] = _run_stats['stages'].get(name, 0) + elapsed
+
+# Reads a JSON file, counting the parsed bytes
+def read_json(file_path):
+    with open(file_path, 'rb') as file:
+        content = file.read()
+
+    count('json_files_parsed')
+    count('json_bytes_parsed', len(content))
+    return json.loads(content)
+
+def write_json(data, file_path, empty_to_null=False, backend='json'):
+    """
+    Write data as JSON to file_path through a temp file that is renamed over it, so readers never
+    see a partial file. Returns the number of bytes written.
+
+    The json backend streams the chunks of iter_json to the file, formatted like
+    json.dump(data, indent=4), without building the text in memory. The orjson backend serialises
+    in one native call, falling back to json when orjson is not installed. With empty_to_null,
+    empty strings are written as null in the same pass.
+    """
+    if backend == 'orjson':
+        try:
+            import orjson
+        except ImportError:
+            print("orjson is not installed, writing JSON with the json module")
+            backend = 'json'
+
+    temp_path = file_path + '.tmp'
+    try:
+        with open(temp_path, 'wb' if backend == 'orjson' else 'w') as file:
+            if backend == 'orjson':
+                if empty_to_null:
+                    nullify_empty_strings(data)
+                file.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+            else:
+                for chunk in iter_json(data, empty_to_null):
+                    file.write(chunk)
+            file.flush()
+            os.fsync(file.fileno())
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+    os.replace(temp_path, file_path)
+    written = os.path.getsize(file_path)
+    count('json_bytes_written', written)
+    return written
+
+# Encodes a JSON scalar, or returns None for containers
+def encode_json_scalar(value, empty_to_null=False):
+    if isinstance(value, str):
+        return 'null' if empty_to_null and value == '' else json.encoder.encode_basestring_ascii(value)
+    if value is None:
+        return 'null'
+    if value is True:
+        return 'true'
+    if value is False:
+        return 'false'
+    if isinstance(value, int):
+        return int.__repr__(value)
+    if isinstance(value, float):
+        if value != value:
+            return 'NaN'
+        if value in (float('inf'), float('-inf')):
+            return 'Infinity' if value > 0 else '-Infinity'
+        return float.__repr__(value)
+    if isinstance(value, (dict, list, tuple)):
+        return None
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def iter_json(data, empty_to_null=False, indent=4):
+    """
+    Yield the JSON text of data in small chunks, the same text json.dumps(data, indent=indent)
+    returns, with empty strings written as null when empty_to_null is set.
+
+    Containers are walked with an explicit stack instead of recursion, and only the open
+    containers are held on it, so memory does not grow with the size of the output.
+    """
+    # Each open container is [items iterator, is a dict, nesting level, no item written yet]
+    stack = []
+    pending = [(data, '')]
+    while pending or stack:
+        if pending:
+            value, prefix = pending.pop()
+            text = encode_json_scalar(value, empty_to_null)
+            if text is not None:
+                yield prefix + text
+            elif not value:
+                yield prefix + ('{}' if isinstance(value, dict) else '[]')
+            else:
+                yield prefix + ('{' if isinstance(value, dict) else '[')
+                is_dict = isinstance(value, dict)
+                stack.append([iter(value.items()) if is_dict else iter(value), is_dict, len(stack) + 1, True])
+            continue
+
+        frame = stack[-1]
+        item = next(frame[0], stack)
+        if item is stack:
+            stack.pop()
+            yield '\n' + ' ' * (indent * (frame[2] - 1)) + ('}' if frame[1] else ']')
+            continue
+
+        prefix = ('\n' if frame[3] else ',\n') + ' ' * (indent * frame[2])
+        frame[3] = False
+        if frame[1]:
+            key, item = item
+            if not isinstance(key, str):
+                key = json.dumps(key)
+            prefix += json.encoder.encode_basestring_ascii(key) + ': '
+        pending.append((item, prefix))
+
+# Replaces empty strings with None throughout data, in place
+def nullify_empty_strings(data):
+    containers = [data] if isinstance(data, (dict, list)) else []
+    while containers:
+        container = containers.pop()
+        keys = container.keys() if isinstance(container, dict) else range(len(container))
+        for key in keys:
+            value = container[key]
+            if value == '' and isinstance(value, str):
+                container[key] = None
+            elif isinstance(value, (dict, list)):
+                containers.append(value)
+
+    return data
+
 # Extracts repertoire, subject, and sample IDs from a JSON file
 def get_repertoire_details(file_path):
     
-    with open(file_path, 'r') as details:
-        data = json.load(details)
-        repertoire_id = data['repertoire_id']
-        subject_id = data['subject_id']
-        sample_id = data['sample_id']
+    data = read_cached_json(file_path)
+    repertoire_id = data['repertoire_id']
+    subject_id = data['subject_id']
+    sample_id = data['sample_id']
     
     return repertoire_id, subject_id, sample_id
 
-# Merges metadata from various sources into a single JSON file in the destination project
-def merge_metadata(metadata_filename, project_dest, tsv_map, pre_processed_map, vdjbase_project_name, repertoire_mapping, chain):
-    project_metadata = None
-    with open(metadata_filename, 'r') as metadata:
-        project_metadata = json.load(metadata)
-
-        for file in tsv_map:
-            repertoire_id, subject_id, sample_id = get_repertoire_details(file['repertoire_ids'])
-            with open(file['annotation_metadata'], 'r') as annotation_metadata:
-                annotation_metadata = json.load(annotation_metadata)
-                update_annotated_metadata(project_metadata, repertoire_id, annotation_metadata)
-        
-        for file in pre_processed_map:
-            repertoire_id, subject_id, sample_id = get_repertoire_details(file['repertoire_ids'])
-            repertoire_id = repertoire_id + "_" + chain
-            with open(file['pre_processed_metadata'], 'r') as pre_processed_metadata:
-                pre_processed_metadata = json.load(pre_processed_metadata)
-                update_pre_processed_metadata(project_metadata, repertoire_id, pre_processed_metadata)
-        
-        new_metadata_path = os.path.join(project_dest, f'{vdjbase_project_name}.json')
-        # Write the updated project_metadata to a new JSON file
-        with open(new_metadata_path, 'w') as new_metadata_file:
-            json.dump(project_metadata, new_metadata_file, indent=4)
+def merge_metadata(metadata_filename, project_dest, tsv_map, pre_processed_map, vdjbase_project_name, repertoire_mapping, chain, incremental=False,
+                   empty_to_null=False, json_backend='json'):
+    """
+    Merge the annotation and pre-processed metadata into the project metadata and write it to
+    <project_dest>/<vdjbase_project_name>.json.
 
-        
-        copy_required_files(repertoire_mapping, tsv_map, project_dest)
+    With incremental, a merge state next to the output records a content hash of every
+    contributing metadata file (reused while its mtime and size are unchanged) and, per repertoire,
+    a hash of its project metadata entry and of its inputs. Repertoires whose hash did not change
+    are taken from the previous output instead of being merged again, so only changed repertoires
+    read their metadata files. The output is the same as a full merge.
+
+    The output is written by write_json; with empty_to_null, empty strings become null as it is
+    written instead of in a second pass over the file.
+    """
+    project_metadata = read_json(metadata_filename)
+    metadata_index = build_metadata_index(project_metadata)
+
+    # Every metadata file that contributes to a repertoire, in merge order: annotations first, then pre-processed results
+    contributions = {}
+    repertoire_index = build_repertoire_index(tsv_map)
+    for records in repertoire_index.values():
+        for repertoire_id, file in records:
+            contributions.setdefault(repertoire_id, []).append((update_annotated_metadata, file.annotation_metadata))
+    
+    for file in pre_processed_map:
+        repertoire_id, subject_id, sample_id = get_repertoire_details(file.repertoire_ids)
+        repertoire_id = repertoire_id + "_" + chain
+        contributions.setdefault(repertoire_id, []).append((update_pre_processed_metadata, file.pre_processed_metadata))
+    
+    new_metadata_path = os.path.join(project_dest, f'{vdjbase_project_name}.json')
+    merge_state_path = os.path.join(project_dest, f'.{vdjbase_project_name}.merge_state.json')
+    merge_state = read_merge_state(merge_state_path, empty_to_null) if incremental else None
+    previous_index = {}
+    if merge_state is not None and merge_state['repertoires'] and os.path.isfile(new_metadata_path):
+        previous_index = build_metadata_index(read_json(new_metadata_path))
+
+    new_state = {'version': MERGE_STATE_VERSION, 'empty_to_null': empty_to_null, 'files': {}, 'repertoires': {}}
+    for repertoire_id, updates in contributions.items():
+        repertoires = metadata_index.get(repertoire_id, [])
+        if not repertoires:
+            continue
+
+        if merge_state is not None:
+            input_hash = merge_input_hash(repertoires, updates, merge_state, new_state)
+            new_state['repertoires'][repertoire_id] = input_hash
+            previous = previous_index.get(repertoire_id, [])
+            if merge_state['repertoires'].get(repertoire_id) == input_hash and len(previous) == len(repertoires):
+                for repertoire, merged in zip(repertoires, previous):
+                    repertoire.clear()
+                    repertoire.update(merged)
+                count('repertoires_merge_reused')
+                continue
+
+        for update, path in updates:
+            update(metadata_index, repertoire_id, read_cached_json(path))
+        count('repertoires_merged')
+    
+    # Write the updated project_metadata to a new JSON file
+    with timed_stage('write_metadata_json'):
+        write_json(project_metadata, new_metadata_path, empty_to_null, json_backend)
+
+    if merge_state is not None:
+        with open(merge_state_path + '.tmp', 'w') as merge_state_file:
+            json.dump(new_state, merge_state_file)
+        os.replace(merge_state_path + '.tmp', merge_state_path)
+
+    return repertoire_index
+
+# Reads the merge state written by the previous incremental merge, or an empty one when it was
+# written by another version or with another empty_to_null setting (the reused entries would differ)
+def read_merge_state(merge_state_path, empty_to_null=False):
+    merge_state = {'version': MERGE_STATE_VERSION, 'empty_to_null': empty_to_null, 'files': {}, 'repertoires': {}}
+    if os.path.isfile(merge_state_path):
+        recorded = read_json(merge_state_path)
+        if recorded.get('version') == MERGE_STATE_VERSION and recorded.get('empty_to_null', False) == empty_to_null:
+            merge_state = recorded
+
+    return merge_state
+
+# Hashes the project metadata entries of a repertoire together with the content hashes of the files merged into it
+def merge_input_hash(repertoires, updates, merge_state, new_state):
+    digest = hashlib.sha256(json.dumps(repertoires, sort_keys=True).encode())
+    for update, path in updates:
+        file_stat = os.stat(path)
+        recorded = merge_state['files'].get(path)
+        if recorded is not None and recorded[0] == file_stat.st_mtime_ns and recorded[1] == file_stat.st_size:
+            file_hash = recorded[2]
+        else:
+            file_hash = file_sha256(path)
+        new_state['files'][path] = [file_stat.st_mtime_ns, file_stat.st_size, file_hash]
+        digest.update(f'{update.__name__}:{file_hash}'.encode())
+
+    return digest.hexdigest()
     
 
+# Parses every repertoire_id.json once and indexes the scan records by the repertoire ID prefix
+# used in the airr_repertoire_id column of airr_correspondence.csv
+def build_repertoire_index(tsv_map):
+    repertoire_index = {}
+    for file in tsv_map:
+        repertoire_id, subject_id, sample_id = get_repertoire_details(file.repertoire_ids)
+        repertoire_index.setdefault(repertoire_id.split('_')[0], []).append((repertoire_id, file))
 
-def copy_required_files(repertoire_mapping, tsv_map, project_dest):
+    return repertoire_index
+
+
+# Builds the copy plan of the required files of every mapped repertoire and transfers it
+def copy_required_files(repertoire_mapping, repertoire_index, project_dest, jobs=1, link_mode='copy', incremental=None, dedup=False):
+    copy_plan = []
+    project_dirs = set()
     for vdjbase_project in repertoire_mapping:
         vdjbase_project = repertoire_mapping[vdjbase_project]
-        vdjbase_project_path = os.path.join(project_dest, 'samples', vdjbase_project['project_number'], vdjbase_project['vdjbase_name'])
+        vdjbase_project_path = os.path.join(project_dest, 'samples', vdjbase_project.project_number, vdjbase_project.vdjbase_name)
+        project_dirs.add(os.path.dirname(vdjbase_project_path))
         if not os.path.exists(vdjbase_project_path):
             os.makedirs(vdjbase_project_path)
         
-        for projcet in tsv_map:
-            repertoire_id = None
-            with open(projcet['repertoire_ids'], 'r') as repertoire:
-                repertoire_data = json.load(repertoire)
-                repertoire_id = repertoire_data['repertoire_id'].split('_')[0]
-              
-            if str(repertoire_id) == str(vdjbase_project['airr_repertoire_id']):
-                for file in projcet['required_files']:
-                    file_name = file.split(SPLIT)[-1]
-                    new_file_name = change_file_name_to_vdjbase(vdjbase_project['vdjbase_name'], file_name)
-                    destination_path = os.path.join(vdjbase_project_path, new_file_name)
-                    copy_file(source_path=file, destination_path= destination_path)
+        for repertoire_id, projcet in repertoire_index.get(vdjbase_project.airr_repertoire_id, []):
+            for file in projcet.required_files:
+                file_name = file.split(SPLIT)[-1]
+                new_file_name = change_file_name_to_vdjbase(vdjbase_project.vdjbase_name, file_name)
+                destination_path = os.path.join(vdjbase_project_path, new_file_name)
+                copy_plan.append((file, destination_path))
+
+    # Place the stored objects instead of the sources; copying them would defeat the store
+    if dedup:
+        copy_plan = dedup_copy_plan(copy_plan, project_dest, jobs)
+        if link_mode == 'copy':
+            link_mode = 'hardlink'
+
+    if incremental is None:
+        transfer_files(copy_plan, jobs, link_mode)
+        return
+
+    pending_plan, sync_entries = plan_incremental_sync(copy_plan, project_dirs, incremental)
+    print(f"Incremental sync: {len(pending_plan)} of {len(copy_plan)} files are new or changed")
+    transfer_files(pending_plan, jobs, link_mode)
+    write_sync_manifests(project_dirs, sync_entries)
+
+
+def dedup_copy_plan(copy_plan, project_dest, jobs=1):
+    """
+    Store every source file of copy_plan once in the object store of project_dest and return the
+    plan with each source replaced by its object.
+
+    Objects are named by the sha256 of their content, <store>/<xx>/<sha256>, so identical files
+    of any project of the target are stored once and placed as links to the same object. The
+    store index records the hash of every source by path, size and mtime, so a source is hashed
+    once and not again until it changes. Sources are hashed and stored on jobs threads, and the new
+    entries are merged into the index under a lock (see update_object_index).
+    """
+    store_path = os.path.join(project_dest, OBJECT_STORE_NAME)
+    index_path = os.path.join(store_path, 'index.json')
+    index = read_json(index_path) if os.path.isfile(index_path) else {}
+
+    def store(source_path):
+        file_stat = os.stat(source_path)
+        recorded = index.get(source_path)
+        if recorded is not None and recorded[0] == file_stat.st_mtime_ns and recorded[1] == file_stat.st_size:
+            digest = recorded[2]
+        else:
+            digest = file_sha256(source_path)
+            count('files_hashed')
+
+        object_path = os.path.join(store_path, digest[:2], digest)
+        if os.path.isfile(object_path):
+            count('objects_reused')
+        else:
+            # Unique temp name: other threads, or batch workers publishing into the same target, may store the same object
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            temp_path = f'{object_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            shutil.copy2(source_path, temp_path)
+            os.replace(temp_path, object_path)
+            count('objects_stored')
+            count('bytes_stored', file_stat.st_size)
+
+        return source_path, [file_stat.st_mtime_ns, file_stat.st_size, digest], object_path
+
+    sources = sorted({source_path for source_path, _ in copy_plan})
+    executor = None
+    if jobs > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=jobs)
+    try:
+        stored = ordered_map(executor, store, sources)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    objects = {}
+    entries = {}
+    for source_path, entry, object_path in stored:
+        entries[source_path] = entry
+        objects[source_path] = object_path
+
+    def add_entries(current_index):
+        current_index.update(entries)
+        return current_index
+
+    update_object_index(store_path, add_entries)
+
+    print(f"Object store: {len(set(objects.values()))} objects for {len(copy_plan)} files")
+    return [(objects[source_path], destination_path) for source_path, destination_path in copy_plan]
+
+
+# Rewrites the store index with update(index) under an exclusive lock. The index is read again under the lock,
+# so entries written meanwhile by batch workers publishing other projects into the same target are kept
+def update_object_index(store_path, update):
+    index_path = os.path.join(store_path, 'index.json')
+    os.makedirs(store_path, exist_ok=True)
+    with open(os.path.join(store_path, 'index.lock'), 'w') as lock_file:
+        try:
+            import fcntl
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        except ImportError:
+            pass
+
+        index = update(read_json(index_path) if os.path.isfile(index_path) else {})
+        temp_path = f'{index_path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as index_file:
+            json.dump(index, index_file)
+        os.replace(temp_path, index_path)
+
+
+def prune_object_store(project_dest):
+    """
+    Delete the objects of the store of project_dest that no placed file refers to any more.
+
+    An object is still in use while it has other hard links, or while a symlink under samples/
+    points to it; reflinked copies do not need their object. Index entries of deleted objects are
+    dropped. Returns the number of objects deleted.
+    """
+    store_path = os.path.join(project_dest, OBJECT_STORE_NAME)
+    if not os.path.isdir(store_path):
+        return 0
+
+    symlinked = set()
+    for root, folders, files in os.walk(os.path.join(project_dest, 'samples')):
+        for name in files:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                symlinked.add(os.path.realpath(path))
+
+    removed = set()
+    removed_bytes = 0
+    for root, folders, files in os.walk(store_path):
+        for name in files:
+            object_path = os.path.join(root, name)
+            if root == store_path or name.endswith('.tmp'):
+                continue
+            file_stat = os.stat(object_path)
+            if file_stat.st_nlink == 1 and os.path.realpath(object_path) not in symlinked:
+                os.unlink(object_path)
+                removed.add(name)
+                removed_bytes += file_stat.st_size
+        if root != store_path and not os.listdir(root):
+            os.rmdir(root)
+
+    if removed:
+        update_object_index(store_path, lambda index: {source_path: entry for source_path, entry in index.items() if entry[2] not in removed})
+
+    print(f"Object store: removed {len(removed)} unreferenced objects ({removed_bytes / 2**20:.1f} MB)")
+    return len(removed)
+
+
+def plan_incremental_sync(copy_plan, project_dirs, check='mtime'):
+    """
+    Compare a copy plan with what a previous incremental run placed in project_dirs.
+
+    A destination is up to date when the sidecar manifest recorded the same source path, size and
+    mtime and the destination still has that size. With check='hash', files whose size or mtime
+    changed are also kept when their sha256 matches the recorded one. Files in project_dirs that
+    are not in the plan are deleted. Returns the part of the plan that still has to be transferred
+    and the sidecar entries describing the synced state.
+    """
+    recorded = {}
+    for project_dir in project_dirs:
+        for relative_path, entry in read_sync_manifest(project_dir).items():
+            recorded[os.path.join(project_dir, relative_path)] = entry
+
+    pending_plan = []
+    sync_entries = {}
+    for source_path, destination_path in copy_plan:
+        source_stat = os.stat(source_path)
+        entry = {'source': source_path, 'size': source_stat.st_size, 'mtime_ns': source_stat.st_mtime_ns}
+        previous = recorded.get(destination_path)
+        intact = previous is not None and previous['source'] == source_path and destination_has_size(destination_path, entry['size'])
+        if intact and previous['size'] == entry['size'] and previous['mtime_ns'] == entry['mtime_ns']:
+            if 'sha256' in previous:
+                entry['sha256'] = previous['sha256']
+            sync_entries[destination_path] = entry
+            continue
+
+        if check == 'hash':
+            entry['sha256'] = file_sha256(source_path)
+            if intact and previous.get('sha256') == entry['sha256']:
+                sync_entries[destination_path] = entry
+                continue
+
+        # Never write through an old link into the file it points to
+        remove_existing_file(destination_path)
+        pending_plan.append((source_path, destination_path))
+        sync_entries[destination_path] = entry
+
+    remove_orphans(project_dirs, {destination_path for _, destination_path in copy_plan})
+    return pending_plan, sync_entries
+
+# Checks that a previously placed file is still there with the expected size
+def destination_has_size(path, size):
+    try:
+        return os.stat(path).st_size == size
+    except OSError:
+        return False
+
+# Deletes files of the project directories that are not part of the plan, and the folders they leave empty
+def remove_orphans(project_dirs, planned_paths):
+    planned_dirs = {os.path.dirname(path) for path in planned_paths}
+    for project_dir in project_dirs:
+        for root, dirs, files in os.walk(project_dir, topdown=False):
+            for file in files:
+                file_path = os.path.join(root, file)
+                if file_path not in planned_paths and not (root == project_dir and file == SYNC_MANIFEST_NAME):
+                    os.unlink(file_path)
+                    print(f"Removed orphan {file_path}")
+            for folder in dirs:
+                folder_path = os.path.join(root, folder)
+                if folder_path not in planned_dirs and not os.listdir(folder_path):
+                    os.rmdir(folder_path)
+
+# Hashes a file in fixed-size chunks
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+# Reads the sidecar manifest of a project directory, relative destination path -> entry
+def read_sync_manifest(project_dir):
+    manifest_path = os.path.join(project_dir, SYNC_MANIFEST_NAME)
+    if not os.path.isfile(manifest_path):
+        return {}
+
+    with open(manifest_path, 'r') as manifest_file:
+        return json.load(manifest_file)
+
+# Writes the sidecar manifest of every project directory atomically
+def write_sync_manifests(project_dirs, sync_entries):
+    for project_dir in project_dirs:
+        entries = {}
+        for destination_path, entry in sync_entries.items():
+            if os.path.dirname(os.path.dirname(destination_path)) == project_dir:
+                entries[os.path.relpath(destination_path, project_dir)] = entry
+
+        manifest_path = os.path.join(project_dir, SYNC_MANIFEST_NAME)
+        with open(manifest_path + '.tmp', 'w') as manifest_file:
+            json.dump(entries, manifest_file, indent=4, sort_keys=True)
+        os.replace(manifest_path + '.tmp', manifest_path)
         
 
 def change_file_name_to_vdjbase(vdjbase_project_name ,file_name):
@@ -81,35 +598,49 @@ def change_file_name_to_vdjbase(vdjbase_project_name ,file_name):
             
             return vdjbase_project_name + '_' + file
 
+# Indexes the Repertoire entries of the project metadata by repertoire_id. Pre-processed results are
+# looked up with the '_<chain>' suffixed ID built in merge_metadata, so both variants hit this index
+def build_metadata_index(project_metadata):
+    metadata_index = {}
+    for repertoire in project_metadata['Repertoire']:
+        metadata_index.setdefault(repertoire['repertoire_id'], []).append(repertoire)
+
+    return metadata_index
+
 # Updates project metadata with annotated metadata for a specific repertoire
-def update_annotated_metadata(project_metadata, repertoire_id, annotation_metadata):
+def update_annotated_metadata(metadata_index, repertoire_id, annotation_metadata):
     new_data = annotation_metadata['sample']['data_processing']
-    for repertoire in project_metadata['Repertoire']:
-        if repertoire['repertoire_id'] == repertoire_id:
-            original_data = repertoire['data_processing'][0]
-            repertoire['data_processing'][0] = merge_json_data_recursive(original_data, new_data)
+    for repertoire in metadata_index.get(repertoire_id, []):
+        original_data = repertoire['data_processing'][0]
+        repertoire['data_processing'][0] = merge_json_data_recursive(original_data, new_data)
 
 # Updates project metadata with pre-processed metadata for a specific repertoire
-def update_pre_processed_metadata(project_metadata, repertoire_id, pre_processed_metadata):
+def update_pre_processed_metadata(metadata_index, repertoire_id, pre_processed_metadata):
     new_data = pre_processed_metadata['sample']['data_processing']
-    for repertoire in project_metadata['Repertoire']:
-        if repertoire['repertoire_id'] == repertoire_id:
-            original_data = repertoire['data_processing'][0]
-            repertoire['data_processing'][0] = merge_json_data_recursive(original_data, new_data)
+    for repertoire in metadata_index.get(repertoire_id, []):
+        original_data = repertoire['data_processing'][0]
+        repertoire['data_processing'][0] = merge_json_data_recursive(original_data, new_data)
 
 
 def merge_json_data_recursive(original_data, new_data):
     """
     Recursively merges new_data into original_data. If a key in new_data already exists in original_data
     and both values are dictionaries, it merges them recursively. If both are lists, it appends the items
-    from the new list to the old list. Otherwise, the value in original_data is updated with the value from new_data.
+    from the new list that are not already in the old list (compared by their canonical JSON), so merging
+    the same data twice does not duplicate items. Otherwise, the value in original_data is updated with the
+    value from new_data.
     """
     for key, value in new_data.items():
         if key in original_data:
             if isinstance(original_data[key], dict) and isinstance(value, dict):
                 merge_json_data_recursive(original_data[key], value)
             elif isinstance(original_data[key], list) and isinstance(value, list):
-                original_data[key].extend(value)
+                existing_items = {json.dumps(item, sort_keys=True) for item in original_data[key]}
+                for item in value:
+                    item_key = json.dumps(item, sort_keys=True)
+                    if item_key not in existing_items:
+                        existing_items.add(item_key)
+                        original_data[key].append(item)
             else:
                 original_data[key] = value
         else:
@@ -118,20 +649,26 @@ def merge_json_data_recursive(original_data, new_data):
     return original_data
 
 
-# Copies content from a source directory to a destination directory and merges metadata
-def copy_folder_content(source_folder, target_repo_path, vdjbase_project_name,project_number, metadata_filename, repertoire_mapping, chain):
+# Copies the content recorded in the source manifest to a destination directory and merges metadata
+def copy_folder_content(manifest, target_repo_path, vdjbase_project_name,project_number, metadata_filename, repertoire_mapping, chain, jobs=1, link_mode='copy', incremental=None,
+                        empty_to_null=False, json_backend='json', dedup=False):
     # Create the destination directory if it does not exist
     if not os.path.exists(target_repo_path):
         os.makedirs(target_repo_path)
     
-    tsv_files_paths, pre_processed_files = find_project_tsv_files(source_folder, chain)
-
-    merge_metadata(metadata_filename, target_repo_path, tsv_files_paths, pre_processed_files, vdjbase_project_name, repertoire_mapping, chain)
+    tsv_files_paths = manifest['annotated']
+    pre_processed_files = manifest['pre_processed']
+
+    with timed_stage('merge_metadata'):
+        repertoire_index = merge_metadata(metadata_filename, target_repo_path, tsv_files_paths, pre_processed_files, vdjbase_project_name, repertoire_mapping, chain,
+                                          incremental is not None, empty_to_null, json_backend)
+    with timed_stage('copy_files'):
+        copy_required_files(repertoire_mapping, repertoire_index, target_repo_path, jobs, link_mode, incremental, dedup)
     
 
-def copy_file(source_path, destination_path):
+def copy_file(source_path, destination_path, link_mode='copy'):
     """
-    Copy a file from source_path to destination_path.
+    Copy a file from source_path to destination_path, placing it according to link_mode.
 
     """
     # Check if the source file exists
@@ -142,97 +679,490 @@ def copy_file(source_path, destination_path):
     os.makedirs(os.path.dirname(destination_path), exist_ok=True)
     
     # Copy the file
-    shutil.copy2(source_path, destination_path)
-    print(f"File copied from {source_path} to {destination_path}")
+    strategy = place_file(source_path, destination_path, link_mode)
+    count_placed_file(destination_path, strategy)
+    print(f"File placed ({strategy}) from {source_path} to {destination_path}")
+    return strategy
 
 
-# Finds TSV files and pre-processed files within a project directory
-def find_project_tsv_files(project_path, chain):
-    pre_processed_folders = []
+def place_file(source_path, destination_path, link_mode='copy'):
+    """
+    Place source_path at destination_path and return the name of the strategy that was used.
+
+    'copy' is a plain shutil.copy2 and 'symlink' links to the absolute source path. 'reflink' and
+    'hardlink' try that strategy and fall back to a kernel copy (copy_file_range, then sendfile)
+    and finally to a buffered copy when the filesystem refuses it. 'auto' tries a reflink, then a
+    hard link, then the same copy fallbacks.
+    """
+    if link_mode == 'copy':
+        shutil.copy2(source_path, destination_path)
+        return 'copy'
+
+    if link_mode == 'symlink':
+        remove_existing_file(destination_path)
+        os.symlink(os.path.abspath(source_path), destination_path)
+        return 'symlink'
+
+    if link_mode == 'reflink':
+        strategies = [('reflink', reflink_file)]
+    elif link_mode == 'hardlink':
+        strategies = [('hardlink', os.link)]
+    elif link_mode == 'auto':
+        strategies = [('reflink', reflink_file), ('hardlink', os.link)]
+    else:
+        raise ValueError(f"Unknown link mode {link_mode}, expected one of {', '.join(LINK_MODES)}")
+
+    strategies += [('copy_file_range', copy_file_range_file), ('sendfile', sendfile_file)]
+    for strategy, place in strategies:
+        remove_existing_file(destination_path)
+        try:
+            place(source_path, destination_path)
+        except OSError:
+            continue
+        if strategy != 'hardlink':
+            shutil.copystat(source_path, destination_path)
+        return strategy
+
+    remove_existing_file(destination_path)
+    with open(source_path, 'rb') as source, open(destination_path, 'wb') as destination:
+        shutil.copyfileobj(source, destination)
+    shutil.copystat(source_path, destination_path)
+    return 'buffered'
+
+# Counts a placed file and, unless it was linked, the bytes copied for it
+def count_placed_file(destination_path, strategy, size=None):
+    count('files_placed')
+    count(f'files_placed_{strategy}')
+    if strategy not in ('hardlink', 'symlink'):
+        count('bytes_copied', size if size is not None else os.path.getsize(destination_path))
+
+# Removes a previously placed file so it can be linked or rewritten in place
+def remove_existing_file(path):
+    if os.path.lexists(path):
+        os.unlink(path)
+
+# Clones the source file into the destination without copying data blocks
+def reflink_file(source_path, destination_path):
     try:
-        annotated_folder_path = os.path.join(project_path, f'{chain}_annotated')
-        annotated_folders = os.listdir(annotated_folder_path)
-        pre_processed_folder_path = os.path.join(project_path, 'pre_processed')
-        if os.path.exists(pre_processed_folder_path):
-            pre_processed_folders = os.listdir(pre_processed_folder_path)
-            
-        tsv_files = start_scan(annotated_folder_path,annotated_folders , False)
-        pre_processed_files = start_scan(pre_processed_folder_path, pre_processed_folders , True)
+        import fcntl
+    except ImportError:
+        raise OSError("reflink is not supported on this platform")
+
+    with open(source_path, 'rb') as source, open(destination_path, 'wb') as destination:
+        fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+
+# Copies the file inside the kernel with copy_file_range
+def copy_file_range_file(source_path, destination_path):
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError("copy_file_range is not supported on this platform")
+
+    with open(source_path, 'rb') as source, open(destination_path, 'wb') as destination:
+        remaining = os.fstat(source.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(source.fileno(), destination.fileno(), remaining)
+            if copied == 0:
+                raise OSError(f"copy_file_range stopped early on {source_path}")
+            remaining -= copied
+
+# Copies the file inside the kernel with sendfile
+def sendfile_file(source_path, destination_path):
+    if not hasattr(os, 'sendfile'):
+        raise OSError("sendfile is not supported on this platform")
+
+    with open(source_path, 'rb') as source, open(destination_path, 'wb') as destination:
+        size = os.fstat(source.fileno()).st_size
+        offset = 0
+        while offset < size:
+            sent = os.sendfile(destination.fileno(), source.fileno(), offset, size - offset)
+            if sent == 0:
+                raise OSError(f"sendfile stopped early on {source_path}")
+            offset += sent
+
+
+# Copies every (source, destination) pair of a copy plan, on a thread pool when jobs > 1
+def transfer_files(copy_plan, jobs=1, link_mode='copy'):
+    if jobs <= 1:
+        for source_path, destination_path in copy_plan:
+            copy_file(source_path=source_path, destination_path=destination_path, link_mode=link_mode)
+        return
+
+    transfer_files_parallel(copy_plan, jobs, link_mode)
+
+
+def transfer_files_parallel(copy_plan, jobs, link_mode='copy', max_in_flight_bytes=MAX_IN_FLIGHT_BYTES):
+    """
+    Copy the files of copy_plan on a pool of jobs threads.
 
-    except Exception as e:
-        print(e)
+    Destination directories are created once up front, at most max_in_flight_bytes are copied at
+    the same time (a larger file is copied alone), and a single progress line, updated at most once
+    per PROGRESS_INTERVAL on a terminal and printed once at the end otherwise (log files), replaces
+    the per-file prints, followed by a count of the placement strategies used. Failed files do not stop the
+    transfer; they are summarised at the end and reported as one error.
+    """
+    failures = []
+    planned = []
+    for source_path, destination_path in copy_plan:
+        try:
+            planned.append((source_path, destination_path, os.path.getsize(source_path)))
+        except OSError as e:
+            failures.append((source_path, e))
+
+    for directory in sorted({os.path.dirname(destination_path) for _, destination_path, _ in planned}):
+        os.makedirs(directory, exist_ok=True)
+
+    total_files = len(planned)
+    total_bytes = sum(size for _, _, size in planned)
+    state = {'in_flight': 0, 'files': 0, 'bytes': 0, 'last_progress': time.monotonic()}
+    strategies = {}
+    condition = threading.Condition()
+    show_progress = sys.stdout.isatty()
+
+    def progress_line():
+        return (f"Copied {state['files']}/{total_files} files ({state['bytes'] / 2**20:.1f}/{total_bytes / 2**20:.1f} MB)"
+                + (f", {len(failures)} failed" if failures else ''))
 
-    return tsv_files, pre_processed_files
+    def copy_one(source_path, destination_path, size):
+        try:
+            strategy = place_file(source_path, destination_path, link_mode)
+            count_placed_file(destination_path, strategy, size)
+            with condition:
+                strategies[strategy] = strategies.get(strategy, 0) + 1
+                state['files'] += 1
+                state['bytes'] += size
+        # Any error, not only OSError: the futures are not inspected, so this is where every failure is recorded
+        except Exception as e:
+            with condition:
+                failures.append((source_path, e))
+        finally:
+            with condition:
+                state['in_flight'] -= size
+                if show_progress and time.monotonic() - state['last_progress'] >= PROGRESS_INTERVAL:
+                    state['last_progress'] = time.monotonic()
+                    print('\r' + progress_line(), end='', flush=True)
+                condition.notify_all()
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for source_path, destination_path, size in planned:
+            # Wait until the new file fits under the in-flight cap
+            with condition:
+                while state['in_flight'] > 0 and state['in_flight'] + size > max_in_flight_bytes:
+                    condition.wait()
+                state['in_flight'] += size
+            executor.submit(copy_one, source_path, destination_path, size)
+
+    if total_files:
+        print(('\r' if show_progress else '') + progress_line())
+        print("Placement strategies: " + ', '.join(f"{strategy}={count}" for strategy, count in sorted(strategies.items())))
+
+    if failures:
+        for source_path, error in failures:
+            print(f"Failed to copy {source_path}. Reason: {error}")
+        raise RuntimeError(f"{len(failures)} of {len(copy_plan)} files failed to copy")
+
+
+# Builds an in-memory manifest of the annotated and pre-processed trees in a single scandir pass
+def build_project_manifest(project_path, chain, scan_workers=1):
+    annotated_folder_path = os.path.join(project_path, f'{chain}_annotated')
+    if not os.path.isdir(annotated_folder_path):
+        raise FileNotFoundError(f"there is no annotated folder for {project_path}")
+
+    manifest = {
+        'project_path': project_path,
+        'annotated_path': annotated_folder_path,
+        'chain': chain,
+        'annotated': [],
+        'pre_processed': [],
+        'final_files': []
+    }
+    scan_tree(annotated_folder_path, False, manifest, scan_workers)
+
+    pre_processed_folder_path = os.path.join(project_path, 'pre_processed')
+    if os.path.isdir(pre_processed_folder_path):
+        scan_tree(pre_processed_folder_path, True, manifest, scan_workers)
+
+    return manifest
+
+# Keeps the annotated runs whose folder is in run_folders, and the pre-processed runs of their repertoires
+def restrict_manifest(manifest, run_folders):
+    run_folders = {os.path.normpath(folder) for folder in run_folders}
+    manifest['annotated'] = [run for run in manifest['annotated'] if os.path.normpath(os.path.dirname(run.annotation_metadata_folder)) in run_folders]
+    repertoire_ids = {get_repertoire_details(run.repertoire_ids)[0].split('_')[0] for run in manifest['annotated']}
+    manifest['pre_processed'] = [run for run in manifest['pre_processed'] if get_repertoire_details(run.repertoire_ids)[0].split('_')[0] in repertoire_ids]
+    return manifest
 
-# Initiates scanning of folders for TSV and metadata files
-def start_scan(folder_path,folders, pre_processed):
+# Finds TSV files and pre-processed files within a project directory
+def find_project_tsv_files(project_path, chain, scan_workers=1):
+    manifest = build_project_manifest(project_path, chain, scan_workers)
+    return manifest['annotated'], manifest['pre_processed']
+
+# Lists a directory once, splitting its entries into sub-folders and file names.
+# With an active scan cache, a directory whose mtime did not change costs a single stat
+def list_directory(path):
+    scan_cache = _active_scan_cache
+    if scan_cache is not None:
+        mtime_ns = os.stat(path).st_mtime_ns
+        scan_cache['seen_dirs'].add(path)
+        cached = scan_cache['dirs'].get(path)
+        if cached is not None and cached[0] == mtime_ns:
+            count('directories_from_cache')
+            return [FolderEntry(name, os.path.join(path, name)) for name in cached[1]], list(cached[2])
+
+    # Names are interned: meta_data, results, repertoire_id.json and the like repeat in every run
+    folders = []
     files = []
-    for subject in folders:
-        subject_path = os.path.join(folder_path, subject)
-        res = scan_subject_folder(subject_path, pre_processed)
-        for file in res:
-            files.append(file)
-    
-    return files
-
-# Scans a subject folder for TSV and metadata files
-def scan_subject_folder(subject_path, pre_processed):
-    tsv_files = []
-    samples = os.listdir(subject_path)
-    for sample in samples:
-        sample_path = os.path.join(subject_path, sample)
-        files = scan_run_folder(sample_path, pre_processed)
-        for file in files:
-            tsv_files.append(file)
-    
-    return tsv_files
-
-# Scans a run folder for TSV and metadata files
-def scan_run_folder(sample_path, pre_processed):
-    tsv_files = []
-    repertoires = os.listdir(sample_path)
-    for rep in repertoires:
-        rep_path = os.path.join(sample_path, rep)
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                folders.append(FolderEntry(sys.intern(entry.name), entry.path))
+            else:
+                files.append(sys.intern(entry.name))
+
+    count('directories_listed')
+    count('directory_entries_listed', len(folders) + len(files))
+    folders.sort()
+    files.sort()
+    if scan_cache is not None:
+        scan_cache['dirs'][path] = (mtime_ns, [folder.name for folder in folders], files)
+        scan_cache['changed_dirs'].add(path)
+
+    return folders, files
+
+
+def open_scan_cache(source_folder, rebuild=False):
+    """
+    Load the scan cache of a source folder into memory.
+
+    The cache is an SQLite file in the source folder holding the listing of every scanned
+    directory, keyed by path and mtime, the parsed content of repertoire_id.json and metadata
+    files, keyed by path, mtime and size, and the row and byte counts of the TSV result files
+    validate_result_files found valid, keyed the same way. With rebuild, the stored entries are ignored and
+    replaced when the cache is saved. Returns None, after a warning, when the cache cannot be
+    opened (e.g. a read-only source folder); a cache that cannot be saved is skipped the same way.
+    """
+    cache_path = os.path.join(source_folder, SCAN_CACHE_NAME)
+    try:
+        connection = sqlite3.connect(cache_path)
+        connection.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER, folders TEXT, files TEXT)')
+        connection.execute('CREATE TABLE IF NOT EXISTS json_files (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, content TEXT)')
+        connection.execute('CREATE TABLE IF NOT EXISTS validations (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, rows INTEGER, bytes INTEGER)')
+        connection.commit()
+    except sqlite3.Error as e:
+        print(f"Scan cache {cache_path} is not available, scanning without it. Reason: {e}")
+        return None
+
+    scan_cache = {
+        'path': cache_path,
+        'connection': connection,
+        'dirs': {},
+        'json': {},
+        'validations': {},
+        'seen_dirs': set(),
+        'seen_json': set(),
+        'seen_validations': set(),
+        'changed_dirs': set(),
+        'changed_json': set(),
+        'changed_validations': set(),
+        # Trees scanned during this run; the other chains of the project share the cache file, see save_scan_cache
+        'scanned_roots': set(),
+        'rebuild': rebuild
+    }
+    if not rebuild:
+        for path, mtime_ns, folders, files in connection.execute('SELECT path, mtime_ns, folders, files FROM dirs'):
+            scan_cache['dirs'][path] = (mtime_ns, [sys.intern(name) for name in json.loads(folders)], [sys.intern(name) for name in json.loads(files)])
+        for path, mtime_ns, size, content in connection.execute('SELECT path, mtime_ns, size, content FROM json_files'):
+            scan_cache['json'][path] = (mtime_ns, size, json.loads(content))
+        for path, mtime_ns, size, rows, size_read in connection.execute('SELECT path, mtime_ns, size, rows, bytes FROM validations'):
+            scan_cache['validations'][path] = ((mtime_ns, size), {'path': path, 'rows': rows, 'bytes': size_read, 'error': None})
+
+    return scan_cache
+
+# Checks that a path is one of roots or inside one of them
+def is_under_roots(path, roots):
+    return any(path == root or path.startswith(root + os.sep) for root in roots)
+
+# Writes the entries listed or parsed during this run to the cache file, dropping the ones that were not seen.
+# Only entries under the trees this run scanned are dropped: the {chain}_annotated trees of the other chains share the file.
+# Validations of runs this run did not publish (watch mode, unmapped repertoires) are kept while their file exists
+def save_scan_cache(scan_cache):
+    connection = scan_cache['connection']
+    roots = scan_cache['scanned_roots']
+    try:
+        with connection:
+            if scan_cache['rebuild']:
+                for root in roots:
+                    connection.execute('DELETE FROM dirs WHERE path = ? OR substr(path, 1, ?) = ?', (root, len(root) + 1, root + os.sep))
+                    connection.execute('DELETE FROM json_files WHERE substr(path, 1, ?) = ?', (len(root) + 1, root + os.sep))
+                    connection.execute('DELETE FROM validations WHERE substr(path, 1, ?) = ?', (len(root) + 1, root + os.sep))
+            else:
+                stale_dirs = [(path,) for path in scan_cache['dirs'] if path not in scan_cache['seen_dirs'] and is_under_roots(path, roots)]
+                stale_json = [(path,) for path in scan_cache['json'] if path not in scan_cache['seen_json'] and is_under_roots(path, roots)]
+                connection.executemany('DELETE FROM dirs WHERE path = ?', stale_dirs)
+                stale_validations = [(path,) for path in scan_cache['validations']
+                                     if path not in scan_cache['seen_validations'] and is_under_roots(path, roots) and not os.path.exists(path)]
+                connection.executemany('DELETE FROM json_files WHERE path = ?', stale_json)
+                connection.executemany('DELETE FROM validations WHERE path = ?', stale_validations)
+
+            connection.executemany('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)', [
+                (path, scan_cache['dirs'][path][0], json.dumps(scan_cache['dirs'][path][1]), json.dumps(scan_cache['dirs'][path][2]))
+                for path in scan_cache['changed_dirs']])
+            connection.executemany('INSERT OR REPLACE INTO json_files VALUES (?, ?, ?, ?)', [
+                (path, scan_cache['json'][path][0], scan_cache['json'][path][1], json.dumps(scan_cache['json'][path][2]))
+                for path in scan_cache['changed_json']])
+            connection.executemany('INSERT OR REPLACE INTO validations VALUES (?, ?, ?, ?, ?)', [
+                (path,) + scan_cache['validations'][path][0] + (scan_cache['validations'][path][1]['rows'], scan_cache['validations'][path][1]['bytes'])
+                for path in scan_cache['changed_validations']])
+    except sqlite3.Error as e:
+        # A run that could not save its cache still published; the next one scans without the new entries
+        print(f"Scan cache {scan_cache['path']} could not be saved. Reason: {e}")
+    finally:
+        connection.close()
+
+# Makes list_directory and read_cached_json use the scan cache of source_folder for the enclosed block, then saves it
+@contextlib.contextmanager
+def use_scan_cache(source_folder, enabled=True, rebuild=False):
+    global _active_scan_cache
+    scan_cache = open_scan_cache(source_folder, rebuild) if enabled else None
+    _active_scan_cache = scan_cache
+    try:
+        yield scan_cache
+    finally:
+        _active_scan_cache = None
+        if scan_cache is not None:
+            save_scan_cache(scan_cache)
+
+# Reads a small source JSON file through the scan cache; the caller gets its own copy it may modify
+def read_cached_json(file_path):
+    scan_cache = _active_scan_cache
+    if scan_cache is None:
+        return read_json(file_path)
+
+    file_stat = os.stat(file_path)
+    scan_cache['seen_json'].add(file_path)
+    cached = scan_cache['json'].get(file_path)
+    if cached is not None and cached[0] == file_stat.st_mtime_ns and cached[1] == file_stat.st_size:
+        count('json_files_from_cache')
+        return copy.deepcopy(cached[2])
+
+    content = read_json(file_path)
+    scan_cache['json'][file_path] = (file_stat.st_mtime_ns, file_stat.st_size, copy.deepcopy(content))
+    scan_cache['changed_json'].add(file_path)
+    return content
+
+def scan_tree(folder_path, pre_processed, manifest, scan_workers=1):
+    """
+    Scan the <subject>/<sample>/<run> folders of a tree and add every complete run to the manifest.
+
+    The tree is listed level by level. With scan_workers > 1 the listings of one level are issued
+    concurrently on that many threads, which hides the per-call latency of NFS/Lustre. Results are
+    always collected in sorted listing order, so the manifest is identical to a serial scan.
+    """
+    if _active_scan_cache is not None:
+        _active_scan_cache['scanned_roots'].add(folder_path)
+
+    executor = None
+    if scan_workers > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=scan_workers)
+
+    try:
+        subjects, _ = list_directory(folder_path)
+        subject_samples = ordered_map(executor, lambda subject: list_directory(subject.path)[0], subjects)
+        samples = [(subject, sample) for subject, sample_folders in zip(subjects, subject_samples) for sample in sample_folders]
+        sample_runs = ordered_map(executor, lambda subject_sample: list_directory(subject_sample[1].path)[0], samples)
+
+        runs = [run for run_folders in sample_runs for run in run_folders]
+
         if not pre_processed:
-            file = find_tsv_and_metadata_for_annotated(rep_path)
+            for res, final_files in ordered_map(executor, scan_annotated_run, runs):
+                manifest['final_files'].extend(final_files)
+                if res is not None:
+                    manifest['annotated'].append(res)
         else:
-            file = find_metadata_for_pre_processed(rep_path)
+            for res in ordered_map(executor, lambda run: find_metadata_for_pre_processed(run.path), runs):
+                if res is not None:
+                    manifest['pre_processed'].append(res)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+# Applies function to every item, on the executor when there is one, returning the results in item order
+def ordered_map(executor, function, items):
+    if executor is None:
+        return [function(item) for item in items]
+
+    return list(executor.map(function, items))
+
+# Scans one annotated run, returning its result and the 'Final' file names found in it
+def scan_annotated_run(run):
+    final_files = []
+    res = find_tsv_and_metadata_for_annotated(run.path, final_files)
+    return res, final_files
+
+class PreProcessedRun(namedtuple('PreProcessedRun', ['repertoire_ids_folder', 'metadata_folder'])):
+    """A complete run of pre_processed, see find_metadata_for_pre_processed and AnnotatedRun."""
+    __slots__ = ()
+
+    @property
+    def repertoire_ids(self):
+        return os.path.join(self.repertoire_ids_folder, 'repertoire_id.json')
+
+    @property
+    def pre_processed_metadata(self):
+        return os.path.join(self.metadata_folder, 'pre_processed_metadata.json')
 
-        if file != None:
-            tsv_files.append(file[0])
-    
-    return tsv_files
+
+class AnnotatedRun(namedtuple('AnnotatedRun', ['tsv_folder', 'file_name', 'repertoire_ids_folder', 'annotation_metadata_folder', 'required_file_parts'])):
+    """
+    A complete run of {chain}_annotated, see find_tsv_and_metadata_for_annotated.
+
+    Scans of large species keep millions of these, so paths are stored as a folder and a file
+    name and joined on access: every file of a folder shares one folder string, and the fixed
+    metadata file names are not stored at all. required_file_parts is a tuple of (folder, name).
+    """
+    __slots__ = ()
+
+    @property
+    def file_path(self):
+        return os.path.join(self.tsv_folder, self.file_name)
+
+    @property
+    def repertoire_ids(self):
+        return os.path.join(self.repertoire_ids_folder, 'repertoire_id.json')
+
+    @property
+    def annotation_metadata(self):
+        return os.path.join(self.annotation_metadata_folder, 'annotation_metadata.json')
+
+    @property
+    def required_files(self):
+        return tuple(os.path.join(folder, name) for folder, name in self.required_file_parts)
 
 # Finds metadata for pre-processed results
 def find_metadata_for_pre_processed(result_path):
-    res_list = []
     res = {
         'repertoire_ids': None,
         'pre_processed_metadata': None
     }
-    result_folders = os.listdir(result_path)
+    result_folders, _ = list_directory(result_path)
     for folder in result_folders:
-        folder_path = os.path.join(result_path, folder)
-        folder_files = os.listdir(folder_path)
-        
-        if 'metadata' in folder:
+        if 'metadata' in folder.name:
+            _, folder_files = list_directory(folder.path)
             if 'pre_processed_metadata.json' in folder_files:
-                res['pre_processed_metadata'] = os.path.join(folder_path, 'pre_processed_metadata.json')
+                res['pre_processed_metadata'] = folder.path
             
             if 'repertoire_id.json' in folder_files:
-                res['repertoire_ids'] = os.path.join(folder_path, 'repertoire_id.json')
+                res['repertoire_ids'] = folder.path
 
     check_result_fileds(res, result_path)
     if all(value is not None for value in res.values()):
-        res_list.append(res)
-        return res_list
+        return PreProcessedRun(res['repertoire_ids'], res['pre_processed_metadata'])
     
     return None     
                 
 
-# Finds TSV files and their corresponding metadata for annotated results
-def find_tsv_and_metadata_for_annotated(result_path):
-    res_list = []
+# Finds TSV files and their corresponding metadata for annotated results, collecting 'Final' file names on the way
+def find_tsv_and_metadata_for_annotated(result_path, final_files):
     res = {
             'file_path': None,
             'file_name': None,
@@ -241,31 +1171,33 @@ def find_tsv_and_metadata_for_annotated(result_path):
             'required_files' : []
         }
     
-    result_folders = os.listdir(result_path)
+    result_folders, _ = list_directory(result_path)
     for folder in result_folders:
-        folder_path = os.path.join(result_path, folder)
-        folder_files = os.listdir(folder_path)
+        _, folder_files = list_directory(folder.path)
         for file in folder_files:
-            if 'Finale' in file:
-                res['file_path'] = os.path.join(folder_path, file)
+            if 'Final' in file:
+                final_files.append(file)
+
+            # Haplotype tables are also named ..._haplotype_Finale_<gene>.tsv; the AIRR Finale TSV takes precedence over them
+            if 'Finale' in file and (res['file_name'] is None or 'haplotype' in res['file_name'] or 'haplotype' not in file):
+                res['file_path'] = folder.path
                 res['file_name'] = file
             
             if file == 'repertoire_id.json':
-                res['repertoire_ids'] = os.path.join(folder_path, file)
+                res['repertoire_ids'] = folder.path
                 
             for required_file in REQUIRED_FILES:
                 if required_file in file:
-                    res['required_files'].append(os.path.join(folder_path, file))
+                    res['required_files'].append((folder.path, file))
 
 
-        if 'meta_data' in folder:
+        if 'meta_data' in folder.name:
             if 'annotation_metadata.json' in folder_files:
-                res['annotation_metadata'] = os.path.join(folder_path, 'annotation_metadata.json')
+                res['annotation_metadata'] = folder.path
 
     check_result_fileds(res, result_path)
     if all(value is not None for value in res.values()):
-        res_list.append(res)
-        return res_list
+        return AnnotatedRun(res['file_path'], res['file_name'], res['repertoire_ids'], res['annotation_metadata'], tuple(res['required_files']))
     
     return None 
 
@@ -281,30 +1213,30 @@ def verify_directory_exists(path):
     if not os.path.exists(path):
         raise FileNotFoundError(f"Directory does not exist: {path}")
 
-def verify_and_clear_project_directory(target_repo_path, project_name):
+def verify_and_clear_project_directory(target_repo_path, project_name, clear=True):
     airr_correspondence_path = os.path.join(target_repo_path, 'airr_correspondence.csv')
     if not os.path.isfile(airr_correspondence_path):
         raise FileNotFoundError(f"airr_correspondence.csv not found in the target repo at {target_repo_path}")
 
-    # Read the CSV file into a DataFrame
-    correspondence_df = pd.read_csv(airr_correspondence_path)
+    correspondence = load_airr_correspondence(airr_correspondence_path)
 
     # Check if the project name is in the airr_file column and extract the first matching vdjbase_name
-    vdjbase_project_name = None
-    for airr_file in correspondence_df['airr_file']:
-        if project_name in airr_file:
-            vdjbase_project_name = correspondence_df[correspondence_df['airr_file'] == airr_file]['vdjbase_name'].str.split('_').str[0].iloc[0]
-            break
-
-    if vdjbase_project_name is None:
+    project_rows = correspondence_rows_for_project(correspondence, project_name)
+    if not project_rows:
         raise ValueError(f"No matching project name {project_name} found in airr_correspondence.csv")
 
+    vdjbase_project_name = project_rows[0].vdjbase_name.split('_')[0]
+
     # Path to the project directory within the target repo
     project_dir_path = os.path.join(target_repo_path, 'samples' ,vdjbase_project_name)
     
     if not os.path.isdir(project_dir_path):
         raise FileNotFoundError(f"Project directory {project_dir_path} does not exist")
 
+    # Incremental runs keep the directory and only remove orphans after planning the copy
+    if not clear:
+        return airr_correspondence_path
+
     # Clear the project directory
     for filename in os.listdir(project_dir_path):
         file_path = os.path.join(project_dir_path, filename)
@@ -320,78 +1252,323 @@ def verify_and_clear_project_directory(target_repo_path, project_name):
     return airr_correspondence_path
 
 
+def load_airr_correspondence(airr_correspondence_path):
+    """
+    Load airr_correspondence.csv once per process and index it.
+
+    Returns a dict holding the rows as CorrespondenceRow tuples, 'by_airr_file' (airr_file -> row
+    positions in file order) and 'by_repertoire_id' (airr_repertoire_id -> rows). All values are
+    read as strings. The result is cached until the file's mtime or size changes, so the stages of
+    a run, and the projects of a batch run, share a single parse.
+    """
+    cache_key = os.path.abspath(airr_correspondence_path)
+    file_stat = os.stat(cache_key)
+    version = (file_stat.st_mtime_ns, file_stat.st_size)
+    cached = _correspondence_cache.get(cache_key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    rows = read_correspondence_rows(cache_key)
+    count('correspondence_files_parsed')
+    count('correspondence_bytes_parsed', file_stat.st_size)
+
+    by_airr_file = {}
+    by_repertoire_id = {}
+    for position, row in enumerate(rows):
+        by_airr_file.setdefault(row.airr_file, []).append(position)
+        by_repertoire_id.setdefault(row.airr_repertoire_id, []).append(row)
+
+    correspondence = {
+        'path': cache_key,
+        'rows': rows,
+        'by_airr_file': by_airr_file,
+        'by_repertoire_id': by_repertoire_id,
+        'by_project': {}
+    }
+    _correspondence_cache[cache_key] = (version, correspondence)
+    return correspondence
+
+# Reads the airr_file, vdjbase_name and airr_repertoire_id columns of airr_correspondence.csv as strings, skipping blank lines
+def read_correspondence_rows(airr_correspondence_path):
+    with open(airr_correspondence_path, 'r', newline='', encoding='utf-8-sig') as correspondence_file:
+        reader = csv.reader(correspondence_file)
+        header = next(reader, [])
+        missing = [column for column in CorrespondenceRow._fields if column not in header]
+        if missing:
+            raise ValueError(f"{airr_correspondence_path} has no {', '.join(missing)} column")
+
+        positions = [header.index(column) for column in CorrespondenceRow._fields]
+        rows = []
+        for values in reader:
+            if not values:
+                continue
+            # Short rows are padded, as missing cells read as empty strings
+            if len(values) < len(header):
+                values += [''] * (len(header) - len(values))
+            rows.append(CorrespondenceRow(*[values[position] for position in positions]))
+
+    return rows
+
+# Returns, in file order, the correspondence rows whose airr_file contains the project name
+def correspondence_rows_for_project(correspondence, project_name):
+    if project_name not in correspondence['by_project']:
+        positions = []
+        for airr_file, file_positions in correspondence['by_airr_file'].items():
+            if project_name in airr_file:
+                positions.extend(file_positions)
+
+        correspondence['by_project'][project_name] = [correspondence['rows'][position] for position in sorted(positions)]
+
+    return correspondence['by_project'][project_name]
+
+
 def derive_vdjbase_project_mapping(airr_correspondence_path, project_name):
-    correspondence_df = pd.read_csv(airr_correspondence_path)
-    
-    # Filter the DataFrame for rows where the vdjbase_name contains the specific project name
-    project_specific_df = correspondence_df[correspondence_df['airr_file'].str.contains(f"{project_name}", regex=True)]
+    correspondence = load_airr_correspondence(airr_correspondence_path)
 
     mapping = {}
-    for index, row in project_specific_df.iterrows():
-        vdjbase_name = row['vdjbase_name']
-        airr_repertoire_id = row['airr_repertoire_id']
+    for row in correspondence_rows_for_project(correspondence, project_name):
+        vdjbase_name = row.vdjbase_name
+        airr_repertoire_id = row.airr_repertoire_id
         
-        # Extract individual and sample from vdjbase_name
-        project_number, individual, sample = vdjbase_name.split('_')
-
-        mapping[vdjbase_name] = {
-            'project_name' : project_name,
-            'vdjbase_name' : vdjbase_name, 
-            'project_number': project_number,
-            'individual': individual,
-            'sample': sample,
-            'airr_repertoire_id': airr_repertoire_id
-        }
+        # Extract individual and sample from vdjbase_name; the parts repeat across rows, so they are interned
+        project_number, individual, sample = (sys.intern(part) for part in vdjbase_name.split('_'))
 
-    return mapping
+        mapping[vdjbase_name] = VdjbaseRepertoire(project_name, vdjbase_name, project_number, individual, sample, airr_repertoire_id)
 
+    return mapping
 
-def verify_annotations_exist(sequence_data_store_path, airr_correspondence_path, project_name, chain):
-    # Read the airr_correspondence.csv to get the expected repertoire IDs and corresponding file patterns
-    correspondence_df = pd.read_csv(airr_correspondence_path)
-    filtered_df = correspondence_df[correspondence_df['airr_file'].str.contains(project_name)]
-    expected_repertoires = filtered_df['airr_repertoire_id'].tolist()
-    
-    #expected_repertoires = correspondence_df['airr_repertoire_id'].to_list()
-    
-    # Dictionary to hold the found 'Final' files
-    found_files = []
 
-    # Walk through the annotated directory to find 'Final' files
-    annotated_path = os.path.join(sequence_data_store_path, f'{chain}_annotated')
-    if not os.path.isdir(annotated_path):
-        raise FileNotFoundError(r"there is no annotated file for {sequence_data_store_path}")
-        
-    
-    for root, dirs, files in os.walk(annotated_path):
-        for file in files:
-            if "Final" in file:
-                found_files.append(file)
-    
-    # Verify that each expected file pattern has at least one matching 'Final' file
-    missing_annotations = []
-    for repertoire in expected_repertoires:
-        
-        found = False
-        for f in found_files:
-            # Convert both operands to strings if they are not already
-            if str(repertoire) in str(f):
-                found = True
-                break
+# With allow_missing, used while a project is still being annotated, missing repertoires are reported instead of raising
+def verify_annotations_exist(manifest, airr_correspondence_path, project_name, allow_missing=False):
+    # Get the expected repertoire IDs from the shared airr_correspondence.csv index
+    correspondence = load_airr_correspondence(airr_correspondence_path)
+    expected_rows = correspondence_rows_for_project(correspondence, project_name)
 
-    if not found:
-        missing_annotations.append(repertoire)
+    # The 'Final' files were already collected while building the manifest
+    found_files = manifest['final_files']
+    found_repertoires = find_repertoires_in_file_names({row.airr_repertoire_id for row in expected_rows}, found_files)
 
+    # Verify that each expected repertoire has at least one matching 'Final' file
+    missing_annotations = []
+    for row in expected_rows:
+        if row.airr_repertoire_id not in found_repertoires:
+            expected_path = os.path.join(manifest['annotated_path'], '<subject>', '<sample>', '<run>', '<folder>', f'*{row.airr_repertoire_id}*Final*')
+            missing_annotations.append(f"{row.airr_repertoire_id} ({row.vdjbase_name}), expected at {expected_path}")
     
-        if not found:
-            missing_annotations.append(repertoire)
-    
+    if missing_annotations and allow_missing:
+        print(f"{len(missing_annotations)} repertoires are not annotated yet and were not published")
+        return False
+
     if missing_annotations:
-        raise FileNotFoundError(f"Missing 'Final' annotation files for the following patterns: {', '.join(missing_annotations)}")
+        raise FileNotFoundError(f"Missing 'Final' annotation files for {len(missing_annotations)} repertoires:\n" + '\n'.join(missing_annotations))
     
     return True  # Return True if all checks pass
 
 
+# Returns the columns a TSV result file must have, or None for files that are not validated
+def tsv_schema(file_name):
+    if not file_name.endswith('.tsv'):
+        return None
+    for name_part, columns in TSV_SCHEMAS:
+        if name_part in file_name:
+            return columns
+
+    return None
+
+
+def validate_tsv(path, required_columns, chunk_size=VALIDATION_CHUNK_SIZE):
+    """
+    Check that a TSV result file is complete, reading it in chunks of chunk_size bytes.
+
+    The header must have required_columns, and the file must have at least one row, every row as
+    many fields as the header and a newline at the end (a crashed job leaves a partial last row).
+    Only one chunk and the partial line carried over from the previous one are held in memory.
+    Returns a result record with the row and byte counts and the error, if any, instead of
+    raising, so files can be checked on worker threads.
+    """
+    result = {'path': path, 'rows': 0, 'bytes': 0, 'error': None}
+    try:
+        field_count = None
+        pending = b''
+        with open(path, 'rb') as tsv_file:
+            while True:
+                chunk = tsv_file.read(chunk_size)
+                if not chunk:
+                    break
+                result['bytes'] += len(chunk)
+                pending += chunk
+                if field_count is None:
+                    end = pending.find(b'\n')
+                    if end < 0:
+                        continue
+                    columns = pending[:end].rstrip(b'\r').decode('utf-8-sig').split('\t')
+                    missing = [column for column in required_columns if column not in columns]
+                    if missing:
+                        raise ValueError(f"the header has no {', '.join(missing)} column")
+                    field_count = len(columns)
+                    pending = pending[end + 1:]
+
+                # Check the complete lines and keep the partial last one for the next chunk
+                end = pending.rfind(b'\n')
+                if end < 0:
+                    continue
+                lines, pending = pending[:end + 1], pending[end + 1:]
+                check_tsv_rows(lines, field_count, result['rows'])
+                result['rows'] += lines.count(b'\n')
+
+        if result['bytes'] == 0:
+            raise ValueError("the file is empty")
+        if field_count is None or pending:
+            raise ValueError(f"the file is truncated, its last line has no newline (after {result['rows']} rows)")
+        if result['rows'] == 0:
+            raise ValueError("the file has a header but no rows")
+
+    except (OSError, ValueError) as e:
+        result['error'] = str(e)
+
+    return result
+
+# Raises ValueError for the first line of a block of complete lines whose field count differs from the header's
+def check_tsv_rows(lines, field_count, rows_before):
+    for row, line in enumerate(lines.split(b'\n')[:-1], start=rows_before + 1):
+        fields = line.count(b'\t') + 1
+        if fields != field_count:
+            raise ValueError(f"row {row} has {fields} fields, the header has {field_count}")
+
+
+def validate_result_files(runs, repertoire_mapping, jobs=1, allow_broken=False):
+    """
+    Validate the Finale TSV, genotype.tsv and haplotype tables of the annotated runs that will be
+    published, the ones of repertoires in repertoire_mapping (see validate_tsv).
+
+    Files are streamed in parallel on jobs threads. Files found valid before, by this process or by
+    an earlier run through the scan cache, are not read again while their size and mtime are
+    unchanged, so a run that republishes a project only reads its new or changed results. Once a broken file is found the files not started yet are
+    cancelled, and a ValueError lists the broken files. With allow_broken (partial publishes) every
+    file is checked instead, and the runs with a broken file are left out, as unannotated
+    repertoires are. Returns the runs to publish. Row and byte counts and the broken files go to
+    the run report.
+    """
+    mapped_ids = {repertoire.airr_repertoire_id for repertoire in repertoire_mapping.values()}
+    planned = {}
+    for run in runs:
+        repertoire_id = get_repertoire_details(run.repertoire_ids)[0]
+        if repertoire_id.split('_')[0] not in mapped_ids:
+            continue
+        for path in (run.file_path,) + run.required_files:
+            required_columns = tsv_schema(os.path.basename(path))
+            if required_columns is not None:
+                planned[path] = required_columns
+
+    # Valid files are remembered per process and, with an active scan cache, across runs
+    scan_cache = _active_scan_cache
+    failures = []
+    pending = []
+    for path, required_columns in sorted(planned.items()):
+        try:
+            file_stat = os.stat(path)
+        except OSError as e:
+            failures.append({'path': path, 'error': str(e)})
+            continue
+
+        version = (file_stat.st_mtime_ns, file_stat.st_size)
+        if scan_cache is not None:
+            scan_cache['seen_validations'].add(path)
+            cached = scan_cache['validations'].get(path)
+            if cached is not None and cached[0] == version:
+                count('tsv_files_validation_reused')
+                continue
+        cached = _validation_cache.get(path)
+        if cached is not None and cached[0] == version:
+            count('tsv_files_validation_reused')
+            if scan_cache is not None:
+                scan_cache['validations'][path] = cached
+                scan_cache['changed_validations'].add(path)
+            continue
+        pending.append((path, required_columns, version))
+
+    if pending and (allow_broken or not failures):
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            futures = {executor.submit(validate_tsv, path, required_columns): version for path, required_columns, version in pending}
+            for future in as_completed(futures):
+                result = future.result()
+                if result['error'] is not None:
+                    failures.append(result)
+                    if allow_broken:
+                        continue
+                    # Fail fast: drop the files not started yet and stop collecting results
+                    for other in futures:
+                        other.cancel()
+                    break
+
+                _validation_cache[result['path']] = (futures[future], result)
+                if scan_cache is not None:
+                    scan_cache['validations'][result['path']] = (futures[future], result)
+                    scan_cache['changed_validations'].add(result['path'])
+                count('tsv_files_validated')
+                count('tsv_rows_validated', result['rows'])
+                count('tsv_bytes_validated', result['bytes'])
+
+    with _run_stats_lock:
+        _run_stats['broken_files'].extend({'path': failure['path'], 'error': failure['error']} for failure in failures)
+    if failures and not allow_broken:
+        count('tsv_files_invalid', len(failures))
+        raise ValueError(f"{len(failures)} result files are broken, the files not checked yet were skipped:\n" + '\n'.join(f"{failure['path']}: {failure['error']}" for failure in failures))
+
+    print(f"Validated {len(planned)} TSV result files")
+    if not failures:
+        return runs
+
+    count('tsv_files_invalid', len(failures))
+    broken_paths = {failure['path'] for failure in failures}
+    valid_runs = [run for run in runs if broken_paths.isdisjoint((run.file_path,) + run.required_files)]
+    count('runs_left_out_invalid', len(runs) - len(valid_runs))
+    for failure in failures:
+        print(f"Broken result file {failure['path']}: {failure['error']}")
+    print(f"{len(runs) - len(valid_runs)} runs have broken result files and were not published")
+    return valid_runs
+
+
+def find_repertoires_in_file_names(repertoire_ids, file_names):
+    """
+    Return the repertoire IDs that appear as a substring of at least one of file_names.
+
+    The file names are first split into tokens on non-alphanumeric characters, which finds the
+    usual '<repertoire>_Finale...' names with one set lookup per token. IDs that are not a whole
+    token (irregular names, IDs containing separators) are then matched by sliding a window of
+    each remaining ID length over every name and looking the window up in a set, so the check
+    stays linear in the number of files whatever the number of repertoires.
+    """
+    tokens = set()
+    for file_name in file_names:
+        tokens.update(re.split(r'[^0-9A-Za-z]+', str(file_name)))
+
+    found = {repertoire_id for repertoire_id in repertoire_ids if repertoire_id in tokens}
+    remaining = {}
+    for repertoire_id in repertoire_ids:
+        if repertoire_id not in found and repertoire_id:
+            remaining.setdefault(len(repertoire_id), set()).add(repertoire_id)
+
+    for file_name in file_names:
+        if not remaining:
+            break
+
+        file_name = str(file_name)
+        for length in list(remaining):
+            candidates = remaining[length]
+            for offset in range(len(file_name) - length + 1):
+                window = file_name[offset:offset + length]
+                if window in candidates:
+                    found.add(window)
+                    candidates.discard(window)
+                    if not candidates:
+                        del remaining[length]
+                        break
+
+    return found
+
+
 def consolidate_metadata(repertoire_metadata_file, additional_metadata_paths):
     with open(repertoire_metadata_file, 'r') as f:
         metadata = json.load(f)
@@ -427,33 +1604,11 @@ def check_files_updated(target_repo_path):
     if not check_file(samples_path):
         raise Exception("samples.zip does not exist or is empty.")
 
-def run_git_command(command):
-    try:
-        result = subprocess.check_output(command, stderr=subprocess.STDOUT, shell=True, universal_newlines=True)
-        return result.strip()
-    except subprocess.CalledProcessError as e:
-        print("Error executing Git command:", e.output)
-        sys.exit(1)
-
-def is_repo_up_to_date(repo_path):
-    # Change to the repository directory
-    original_dir = subprocess.os.getcwd()
-    subprocess.os.chdir(repo_path)
-
-    # Fetch the latest updates from remote without merging
-    run_git_command("git fetch")
-
-    # Get the latest commit hash of the local branch
-    local_commit = run_git_command("git rev-parse HEAD")
-
-    # Get the latest commit hash of the remote branch
-    remote_commit = run_git_command("git rev-parse @{u}")
-
-    # Change back to the original directory
-    subprocess.os.chdir(original_dir)
-
-    return local_commit == remote_commit
-
+# Checks that the digby_data repo is on the same commit as its upstream, reading its refs in-process (see git_state); the upstream is fetched at most once per fetch_ttl seconds
+def is_repo_up_to_date(repo_path, fetch_ttl=None):
+    # Imported here, only runs with check_repo need it
+    import git_state
+    return git_state.is_repo_up_to_date(repo_path, git_state.FETCH_TTL if fetch_ttl is None else fetch_ttl)
 
 
 def ordinal(n):
@@ -467,67 +1622,161 @@ def update_description_file(target_repo_path):
         formatted_date = date.strftime(f"{ordinal(date.day)} %B %Y")
         file.write(f'Analysis of {res[-2]} {res[-1]} datsets, compiled {formatted_date}')
 
-def convert_empty_to_null(json_file):
-    # Read the JSON file
-    with open(json_file, 'r') as file:
-        data = json.load(file)
-
-    # Function to recursively convert empty strings to null
-    def convert(obj):
-        if isinstance(obj, dict):
-            for key, value in obj.items():
-                obj[key] = convert(value)
-        elif isinstance(obj, list):
-            return [convert(item) for item in obj]
-        elif obj == "":
-            return None
-        else:
-            return obj
+# Rewrites a JSON file with its empty strings replaced by null
+def convert_empty_to_null(json_file, json_backend='json'):
+    write_json(read_json(json_file), json_file, empty_to_null=True, backend=json_backend)
+    print(f"Conversion completed for {json_file}")
 
-    # Convert the JSON data
-    converted_data = convert(data)
 
-    # Write the modified JSON back to the file
-    with open(json_file, 'w') as file:
-        json.dump(converted_data, file, indent=4)
+# Publishes one project and chain into the target repo, raising on any failure
+def run_project(project_name, source_folder, metadata_filename, target_repo_path, jobs=1, link_mode='copy', incremental=None, use_cache=True, rebuild_cache=False,
+                scan_workers=1, empty_to_null=False, json_backend='json', partial=False, dedup=False, check_repo=False,
+                validate=True, run_folders=None):
+    verify_directory_exists(source_folder)
+    with use_scan_cache(source_folder, use_cache, rebuild_cache):
+        return publish_project(project_name, source_folder, metadata_filename, target_repo_path, jobs, link_mode, incremental, scan_workers, empty_to_null, json_backend,
+                               partial, dedup, check_repo, validate, run_folders)
+
+
+def publish_project(project_name, source_folder, metadata_filename, target_repo_path, jobs=1, link_mode='copy', incremental=None, scan_workers=1, empty_to_null=False,
+                    json_backend='json', partial=False, dedup=False, check_repo=False, validate=True,
+                    run_folders=None):
+    parts = target_repo_path.rstrip('/').split('/')
+    repo_path = '/'.join(parts[:-3])
+    chain = parts[-1]
+
+    if check_repo:
+        with timed_stage('repo_check'):
+            if not is_repo_up_to_date(repo_path):
+                raise RuntimeError(f"The repository {repo_path} is not up-to-date with its remote repository.")
+        print("The repository is up-to-date with the remote repository.")
+
+    #Verify that the source folder and target repo path exist
+
+    verify_directory_exists(source_folder)
+    verify_directory_exists(target_repo_path)
+
+    # Scan the source tree once; every later stage reads from this manifest
+    with timed_stage('scan'):
+        manifest = build_project_manifest(source_folder, chain, scan_workers)
+        # Only the given runs (watch mode); the others, still being written, are left out as unannotated repertoires are
+        if run_folders is not None:
+            restrict_manifest(manifest, run_folders)
+    count('annotated_runs', len(manifest['annotated']))
+    count('pre_processed_runs', len(manifest['pre_processed']))
+
+    # Verify airr_correspondence.csv file exists and get the mapping
+    with timed_stage('correspondence'):
+        airr_correspondence_path = verify_and_clear_project_directory(target_repo_path, project_name, clear=False) #need to add the check of contains references to a file matching the project, in the airr_file column.
+        repertoire_mapping = derive_vdjbase_project_mapping(airr_correspondence_path, project_name)
 
-    print(f"Conversion completed for {json_file}")
+    # Check the result files of the mapped runs before the project directory is cleared or anything is copied
+    if validate:
+        with timed_stage('validate_results'):
+            manifest['annotated'] = validate_result_files(manifest['annotated'], repertoire_mapping, jobs, allow_broken=partial)
 
+    if incremental is None:
+        verify_and_clear_project_directory(target_repo_path, project_name)
+    
+    # Verify annotations exist
+    with timed_stage('verify_annotations'):
+        verify_annotations_exist(manifest, airr_correspondence_path, project_name, allow_missing=partial)
+    
+    first_key = next(iter(repertoire_mapping.keys()))# Access the first key
+    project_number = repertoire_mapping[first_key].project_number
+    
+    vdjbase_project_name = project_number + ('_' + project_name)
+    copy_folder_content(manifest, target_repo_path, vdjbase_project_name, project_number, metadata_filename, repertoire_mapping, chain, jobs, link_mode, incremental,
+                        empty_to_null, json_backend, dedup)
+
+    print("Data copy completed successfully.")
+    return project_number
+
+
+def main(project_name, source_folder, metadata_filename, target_repo_path, jobs=1, link_mode='copy', incremental=None, report_path=None, profile=False, update_zip=False,
+         use_cache=True, rebuild_cache=False, scan_workers=1, empty_to_null=False, json_backend='json', dedup=False, prune_objects=False,
+         check_repo=False, validate=True):
+    reset_run_stats()
+    report = {
+        'project_name': project_name,
+        'source_folder': source_folder,
+        'metadata_filename': metadata_filename,
+        'target_repo_path': target_repo_path,
+        'started': datetime.datetime.now().isoformat(timespec='seconds'),
+        'status': 'success'
+    }
+    profiler = None
+    if profile:
+        import cProfile
+        import tracemalloc
+        tracemalloc.start()
+        profiler = cProfile.Profile()
+        profiler.enable()
 
-def main(project_name, source_folder, metadata_filename, target_repo_path):
     try:
-        parts = target_repo_path.split('/')
-        repo_path = '/'.join(parts[:-3])
-        chain = parts[-1]
+        with timed_stage('total'):
+            project_number = run_project(project_name, source_folder, metadata_filename, target_repo_path, jobs, link_mode, incremental, use_cache, rebuild_cache, scan_workers,
+                                         empty_to_null, json_backend, dedup=dedup, check_repo=check_repo, validate=validate)
+            if prune_objects:
+                prune_object_store(target_repo_path)
+            if update_zip:
+                # Imported here, zipfile and its compressors are only needed for this step
+                import samples_zip
+                with timed_stage('samples_zip'):
+                    report['samples_zip'] = samples_zip.update_samples_zip(target_repo_path, [project_number])
 
-        #Verify that the source folder and target repo path exist
-        #if is_repo_up_to_date(repo_path):
-        #    print("The repository is up-to-date with the remote GitHub repository.")
-        #else:
-        #    raise Exception("The repository is not up-to-date with the remote GitHub repository.")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+        report['status'] = 'failed'
+        report['error'] = f"{type(e).__name__}: {e}"
 
-        verify_directory_exists(source_folder)
-        verify_directory_exists(target_repo_path)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            report['profile'] = profile_summary(profiler, report_path)
 
-        # Verify airr_correspondence.csv file exists and get the mapping
-        airr_correspondence_path = verify_and_clear_project_directory(target_repo_path, project_name) #need to add the check of contains references to a file matching the project, in the airr_file column.
-        repertoire_mapping = derive_vdjbase_project_mapping(airr_correspondence_path, project_name)
-        
-        # Verify annotations exist
-        verify_annotations_exist(source_folder, airr_correspondence_path, project_name, chain)
-        
-        first_key = next(iter(repertoire_mapping.keys()))# Access the first key
-        project_number = repertoire_mapping[first_key]['project_number']
-        
-        vdjbase_project_name = project_number + ('_' + project_name)
-        copy_folder_content(source_folder, target_repo_path, vdjbase_project_name, project_number, metadata_filename, repertoire_mapping, chain)
+        report.update(get_run_stats())
+        if report_path:
+            write_run_report(report_path, report)
 
-        print("Data copy completed successfully.")
-        #convert_empty_to_null(metadata_filename)
 
+def profile_summary(profiler, report_path=None, limit=25):
+    """
+    Summarise a finished cProfile run and the tracemalloc trace started with it.
 
-    except Exception as e:
-        print(f"An error occurred: {e}")
+    Prints the top functions by cumulative time and returns them, with the peak traced memory, for
+    the run report. With a report path, the raw profile is also dumped next to it as <report>.prof
+    for snakeviz or pstats.
+    """
+    import io
+    import pstats
+    import tracemalloc
+
+    current_memory, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    stats = pstats.Stats(profiler, stream=io.StringIO()).sort_stats('cumulative')
+    if report_path:
+        stats.dump_stats(report_path + '.prof')
+
+    hot_paths = []
+    for (file_name, line, function), (calls, _, own_time, cumulative_time, _) in sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:limit]:
+        hot_paths.append({
+            'function': f'{os.path.basename(file_name)}:{line}({function})',
+            'calls': calls,
+            'own_seconds': round(own_time, 6),
+            'cumulative_seconds': round(cumulative_time, 6)
+        })
+        print(f"{cumulative_time:10.4f}s {own_time:10.4f}s {calls:>9} {hot_paths[-1]['function']}")
+
+    print(f"Peak traced memory: {peak_memory / 2**20:.1f} MB")
+    return {'peak_memory_bytes': peak_memory, 'hot_paths': hot_paths}
+
+# Writes the run report as JSON
+def write_run_report(report_path, report):
+    report['finished'] = datetime.datetime.now().isoformat(timespec='seconds')
+    with open(report_path, 'w') as report_file:
+        json.dump(report, report_file, indent=4)
 
 
 if __name__ == "__main__":
@@ -539,10 +1788,29 @@ if __name__ == "__main__":
     parser.add_argument('source_folder', type=str, help='Path to the source folder')
     parser.add_argument('metadata_filename', type=str, help='Path to the metadata file')
     parser.add_argument('target_repo_path', type=str, help='Path to the target repository')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of files to copy in parallel')
+    parser.add_argument('--link-mode', choices=LINK_MODES, default='copy', help='How files are placed in the target repository')
+    parser.add_argument('--incremental', nargs='?', const='mtime', choices=['mtime', 'hash'], default=None,
+                        help='Copy only new or changed files and delete orphans instead of clearing the project directory; '
+                             'changes are detected by size and mtime, or also by content hash')
+    parser.add_argument('--report', type=str, default=None, help='Write stage timings and counters of the run as JSON to this path')
+    parser.add_argument('--profile', action='store_true', help='Profile the run with cProfile and tracemalloc')
+    parser.add_argument('--update-samples-zip', action='store_true', help='Update samples.zip for the published project')
+    parser.add_argument('--no-cache', action='store_true', help='Scan the source folder without the scan cache')
+    parser.add_argument('--rebuild-cache', action='store_true', help='Ignore the stored scan cache and rebuild it')
+    parser.add_argument('--scan-workers', type=int, default=1, help='Number of directories listed concurrently while scanning the source folder')
+    parser.add_argument('--empty-to-null', action='store_true', help='Write empty strings of the merged project metadata as null')
+    parser.add_argument('--json-backend', choices=JSON_BACKENDS, default='json', help='Encoder of the merged project metadata JSON')
+    parser.add_argument('--dedup', action='store_true', help=f'Store each distinct file once in {OBJECT_STORE_NAME} of the target and place links to it')
+    parser.add_argument('--prune-objects', action='store_true', help='Delete objects of the store that no placed file refers to any more')
+    parser.add_argument('--no-validate', action='store_true', help='Publish without checking the headers, rows and completeness of the TSV result files')
+    parser.add_argument('--check-repo', action='store_true', help='Fail unless the repository holding the target is up-to-date with its remote (fetched at most every few minutes)')
 
     # Parse the arguments
     args = parser.parse_args()
-    main(args.project_name, args.source_folder, args.metadata_filename, args.target_repo_path)
+    main(args.project_name, args.source_folder, args.metadata_filename, args.target_repo_path, args.jobs, args.link_mode, args.incremental, args.report, args.profile, args.update_samples_zip,
+         not args.no_cache, args.rebuild_cache, args.scan_workers, args.empty_to_null, args.json_backend, args.dedup, args.prune_objects,
+         args.check_repo, not args.no_validate)
    
    # Hardcoded for demonstration purposes
     # project_name = r"PRJEB26509"
@@ -0,0 +1,251 @@
+import os
+import sys
+import csv
+import json
+import glob
+import time
+import argparse
+import datetime
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import samples_zip
+import Annotation_to_VDJbase as converter
+
+JOB_FIELDS = ['project', 'source', 'metadata', 'target']
+
+# Reads a job list from a CSV file with a project,source,metadata,target header or from a JSON list of objects with those keys
+def read_job_file(job_file):
+    with open(job_file, 'r', newline='') as file:
+        if job_file.endswith('.json'):
+            jobs = json.load(file)
+        else:
+            jobs = list(csv.DictReader(file))
+
+    for job in jobs:
+        missing = [field for field in JOB_FIELDS if not job.get(field)]
+        if missing:
+            raise ValueError(f"Job {job} in {job_file} is missing {', '.join(missing)}")
+
+    return [{field: job[field] for field in JOB_FIELDS} for job in jobs]
+
+# Expands a glob of project folders (<sequence_data_store>/<project>) into one job per project and target chain
+def jobs_from_glob(pattern, targets, metadata_name):
+    jobs = []
+    for project_path in sorted(glob.glob(pattern)):
+        project_path = project_path.rstrip('/')
+        project = os.path.basename(project_path)
+        source = os.path.join(project_path, 'runs', 'current')
+        for target in targets:
+            chain = os.path.basename(target.rstrip('/'))
+            # Only chains that were annotated for this project
+            if not os.path.isdir(os.path.join(source, f'{chain}_annotated')):
+                continue
+
+            jobs.append({
+                'project': project,
+                'source': source,
+                'metadata': os.path.join(project_path, 'project_metadata', metadata_name.format(project=project, chain=chain)),
+                'target': target
+            })
+
+    return jobs
+
+# Drops repeated (project, target) jobs, which would publish into the same files
+def unique_jobs(jobs):
+    seen = set()
+    unique = []
+    for job in jobs:
+        key = (job['project'], os.path.normpath(job['target']))
+        if key in seen:
+            print(f"Skipping duplicate job for {job['project']} in {job['target']}")
+            continue
+        seen.add(key)
+        unique.append(job)
+
+    return unique
+
+
+def run_job(job, jobs=1, link_mode='copy', incremental=None, log_dir=None, use_cache=True, rebuild_cache=False, scan_workers=1, empty_to_null=False, json_backend='json',
+            dedup=False, check_repo=False, validate=True):
+    """
+    Publish one job and return its result record instead of raising.
+
+    Runs in a worker process; the airr_correspondence.csv cache of Annotation_to_VDJbase lives in
+    that process, so every job the worker handles for the same target reuses one parse. With
+    log_dir, the job's output goes to <log_dir>/<project>_<chain>.log instead of the console. With
+    check_repo, jobs publishing into the same repo share one fetch of its remote (see git_state).
+    """
+    result = dict(job)
+    started = time.time()
+    converter.reset_run_stats()
+    try:
+        if log_dir:
+            chain = os.path.basename(job['target'].rstrip('/'))
+            with open(os.path.join(log_dir, f"{job['project']}_{chain}.log"), 'w') as log, contextlib.redirect_stdout(log):
+                result['project_number'] = converter.run_project(job['project'], job['source'], job['metadata'], job['target'], jobs, link_mode, incremental, use_cache, rebuild_cache, scan_workers,
+                                                                 empty_to_null, json_backend, dedup=dedup, check_repo=check_repo, validate=validate)
+        else:
+            result['project_number'] = converter.run_project(job['project'], job['source'], job['metadata'], job['target'], jobs, link_mode, incremental, use_cache, rebuild_cache, scan_workers,
+                                                                 empty_to_null, json_backend, dedup=dedup, check_repo=check_repo, validate=validate)
+
+        result['status'] = 'success'
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = f"{type(e).__name__}: {e}"
+
+    result['seconds'] = round(time.time() - started, 3)
+    result.update(converter.get_run_stats())
+    return result
+
+
+def run_batch(jobs, workers=None, file_jobs=1, link_mode='copy', incremental=None, log_dir=None, use_cache=True, rebuild_cache=False, scan_workers=1, empty_to_null=False,
+              json_backend='json', dedup=False, check_repo=False, validate=True):
+    """
+    Publish every job, running projects in parallel on a pool of worker processes.
+
+    A failing project never stops the others: its error is recorded in its result. A worker
+    process that dies breaks the whole pool, and the pool cannot tell which job killed it, so the
+    jobs that did not finish are run again, each in a process of its own (see run_isolated); only
+    the job that dies again is marked failed. Returns a report with one result per job, in job
+    order, and the success and failure counts.
+    """
+    jobs = unique_jobs(jobs)
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+
+    options = (file_jobs, link_mode, incremental, log_dir, use_cache, rebuild_cache, scan_workers, empty_to_null, json_backend, dedup, check_repo, validate)
+    started = datetime.datetime.now()
+    results = [None] * len(jobs)
+    done = 0
+    if workers == 1:
+        for position, job in enumerate(jobs):
+            results[position] = run_job(job, *options)
+            print_result(results[position], position + 1, len(jobs))
+    else:
+        unfinished = []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(run_job, job, *options): position for position, job in enumerate(jobs)}
+            for future in as_completed(futures):
+                position = futures[future]
+                try:
+                    results[position] = future.result()
+                except BrokenProcessPool:
+                    unfinished.append(position)
+                    continue
+                except Exception as e:
+                    results[position] = dict(jobs[position], status='failed', error=f"Worker failed: {type(e).__name__}: {e}")
+                done += 1
+                print_result(results[position], done, len(jobs))
+
+        if unfinished:
+            print(f"A worker process died; running the {len(unfinished)} unfinished jobs again, each in its own process")
+            for position, result in run_isolated([jobs[position] for position in sorted(unfinished)], sorted(unfinished), workers, options):
+                results[position] = result
+                done += 1
+                print_result(result, done, len(jobs))
+
+    return {
+        'started': started.isoformat(timespec='seconds'),
+        'finished': datetime.datetime.now().isoformat(timespec='seconds'),
+        'succeeded': sum(1 for result in results if result['status'] == 'success'),
+        'failed': sum(1 for result in results if result['status'] != 'success'),
+        'results': results
+    }
+
+
+def run_isolated(jobs, positions, workers, options):
+    """
+    Run every job in a single-process pool of its own, workers of them at a time, yielding
+    (position, result) as they finish. A process that dies takes only its own job down.
+    """
+    def run_alone(job):
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            try:
+                return executor.submit(run_job, job, *options).result()
+            except BrokenProcessPool as e:
+                return dict(job, status='failed', error=f"Worker process died: {type(e).__name__}: {e}")
+            except Exception as e:
+                return dict(job, status='failed', error=f"Worker failed: {type(e).__name__}: {e}")
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as threads:
+        futures = {threads.submit(run_alone, job): position for job, position in zip(jobs, positions)}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+# Updates samples.zip once per target for all the projects that were published into it
+def update_samples_zips(report, jobs=None):
+    published = {}
+    for result in report['results']:
+        if result['status'] == 'success':
+            published.setdefault(result['target'], []).append(result['project_number'])
+
+    for target, project_numbers in published.items():
+        try:
+            samples_zip.update_samples_zip(target, sorted(set(project_numbers)), jobs)
+        except Exception as e:
+            print(f"Failed to update {samples_zip.SAMPLES_ZIP_NAME} in {target}. Reason: {e}")
+            report.setdefault('samples_zip_failures', []).append({'target': target, 'error': f"{type(e).__name__}: {e}"})
+
+
+def print_result(result, done, total):
+    print(f"[{done}/{total}] {result['project']} -> {result['target']}: {result['status']}"
+          + (f" ({result['error']})" if result['status'] != 'success' else ''))
+
+
+def print_report(report):
+    print(f"Batch finished: {report['succeeded']} succeeded, {report['failed']} failed")
+    for result in report['results']:
+        if result['status'] != 'success':
+            print(f"  {result['project']} -> {result['target']}: {result['error']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Publish many projects and chains into the VDJbase repository in one run.')
+
+    # Add arguments
+    parser.add_argument('--job-file', type=str, help='CSV or JSON job list with project, source, metadata and target')
+    parser.add_argument('--glob', type=str, help='Glob of project folders in the sequence data store, e.g. "/data/sequence_data_store/PRJ*"')
+    parser.add_argument('--target', action='append', default=[], help='Target repository chain folder used with --glob, repeat once per chain')
+    parser.add_argument('--metadata-name', type=str, default='metadata.json', help='Metadata file name under project_metadata used with --glob; {project} and {chain} are substituted')
+    parser.add_argument('--workers', type=int, default=None, help='Number of projects published in parallel (default: number of cores)')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of files copied in parallel within a project')
+    parser.add_argument('--link-mode', choices=converter.LINK_MODES, default='copy', help='How files are placed in the target repository')
+    parser.add_argument('--incremental', nargs='?', const='mtime', choices=['mtime', 'hash'], default=None, help='Incremental sync instead of clearing each project directory')
+    parser.add_argument('--log-dir', type=str, help='Write each job output to <log-dir>/<project>_<chain>.log')
+    parser.add_argument('--report', type=str, help='Write the consolidated report as JSON to this path')
+    parser.add_argument('--no-cache', action='store_true', help='Scan the source folders without their scan cache')
+    parser.add_argument('--rebuild-cache', action='store_true', help='Ignore the stored scan caches and rebuild them')
+    parser.add_argument('--scan-workers', type=int, default=1, help='Number of directories listed concurrently while scanning each source folder')
+    parser.add_argument('--empty-to-null', action='store_true', help='Write empty strings of the merged project metadata as null')
+    parser.add_argument('--json-backend', choices=converter.JSON_BACKENDS, default='json', help='Encoder of the merged project metadata JSON')
+    parser.add_argument('--dedup', action='store_true', help=f'Store each distinct file once in {converter.OBJECT_STORE_NAME} of each target and place links to it')
+    parser.add_argument('--no-validate', action='store_true', help='Publish without checking the headers, rows and completeness of the TSV result files')
+    parser.add_argument('--check-repo', action='store_true', help='Fail jobs whose target repository is not up-to-date with its remote')
+    parser.add_argument('--update-samples-zip', action='store_true', help='Update samples.zip of every target once all its projects are published')
+
+    # Parse the arguments
+    args = parser.parse_args()
+    batch_jobs = []
+    if args.job_file:
+        batch_jobs.extend(read_job_file(args.job_file))
+    if args.glob:
+        if not args.target:
+            parser.error('--glob needs at least one --target')
+        batch_jobs.extend(jobs_from_glob(args.glob, args.target, args.metadata_name))
+    if not batch_jobs:
+        parser.error('no jobs given, use --job-file and/or --glob')
+
+    report = run_batch(batch_jobs, args.workers, args.jobs, args.link_mode, args.incremental, args.log_dir, not args.no_cache, args.rebuild_cache, args.scan_workers,
+                       args.empty_to_null, args.json_backend, args.dedup, args.check_repo,
+                       not args.no_validate)
+    if args.update_samples_zip:
+        update_samples_zips(report, args.workers)
+    print_report(report)
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump(report, report_file, indent=4)
+
+    sys.exit(1 if report['failed'] or report.get('samples_zip_failures') else 0)
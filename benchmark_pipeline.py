@@ -0,0 +1,289 @@
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import platform
+import tempfile
+import subprocess
+import datetime
+import statistics
+import tracemalloc
+import contextlib
+
+import Annotation_to_VDJbase as converter
+
+PROJECT_NAME = 'PRJBENCH'
+PROJECT_NUMBER = 'P1'
+REPERTOIRES_PER_SAMPLE = 1
+# Command-line entry points whose start-up time is checked by benchmark_startup
+ENTRY_POINTS = ['Annotation_to_VDJbase.py', 'remove_chain_from_repertoire.py']
+# The workflow manager starts these scripts hundreds of times per run, so each must start within this many seconds
+STARTUP_BUDGET = 0.1
+
+# Writes a JSON file, creating its folder
+def write_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as file:
+        json.dump(data, file, indent=4)
+
+# Writes a text file, creating its folder
+def write_text(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as file:
+        file.write(text)
+
+
+def generate_data_store(root, repertoires, chain='IGH', subjects=None, rows=20, seed=0):
+    """
+    Generate a synthetic sequence_data_store project and digby_data target under root.
+
+    The source follows the real layout: {chain}_annotated/<subject>/<sample>/<run>/ with a
+    meta_data folder (repertoire_id.json, annotation_metadata.json) and a results folder (the
+    Finale TSV, genotype.tsv, haplotype tables and the ogrdb report and plots), plus the matching
+    pre_processed/<subject>/<sample>/<run>/metadata tree. The project metadata JSON and an
+    airr_correspondence.csv, which also lists rows of other projects, complete the set. Returns
+    the (project_name, source_folder, metadata_filename, target_repo_path) arguments of main.
+    """
+    generator = random.Random(seed)
+    subjects = subjects or max(1, repertoires // 4)
+    project_path = os.path.join(root, 'sequence_data_store', PROJECT_NAME)
+    source_folder = os.path.join(project_path, 'runs', 'current')
+    target_repo_path = os.path.join(root, 'digby_data', 'AIRR-seq', 'Human', chain)
+
+    metadata_repertoires = []
+    correspondence_rows = []
+    for index in range(repertoires):
+        repertoire_id = f'{index:08x}{generator.getrandbits(32):08x}'
+        subject = f'S{index % subjects:05d}'
+        sample = f'{subject}_sample{index // subjects:03d}'
+        run = f'SRR{1000000 + index}'
+
+        run_path = os.path.join(source_folder, f'{chain}_annotated', subject, sample, run)
+        write_json(os.path.join(run_path, 'meta_data', 'repertoire_id.json'),
+                   {'repertoire_id': f'{repertoire_id}_{chain}', 'subject_id': subject, 'sample_id': sample})
+        write_json(os.path.join(run_path, 'meta_data', 'annotation_metadata.json'),
+                   {'sample': {'data_processing': {'software_versions': 'piglet 1.0', 'data_processing_files': [f'{run}_Finale.tsv']}}})
+
+        results_path = os.path.join(run_path, 'results')
+        airr_rows = ''.join(f'{run}_{row}\tT\t{chain}V1-2*0{row % 3 + 1}\t{chain}J4*02\n' for row in range(rows))
+        write_text(os.path.join(results_path, f'{repertoire_id}_Finale.tsv'), 'sequence_id\tproductive\tv_call\tj_call\n' + airr_rows)
+        write_text(os.path.join(results_path, f'{repertoire_id}_genotype.tsv'), 'gene\talleles\tcounts\n' + f'{chain}V1-2\t01,02\t10,12\n' * rows)
+        write_text(os.path.join(results_path, f'{repertoire_id}_haplotype_Finale_{chain}J6.tsv'), 'gene\thap_1\thap_2\n' + f'{chain}V1-2\t01\t02\n' * rows)
+        write_text(os.path.join(results_path, f'{repertoire_id}_ogrdb_report.csv'), 'gene,allele,count\n' + f'{chain}V1-2,01,10\n' * rows)
+        with open(os.path.join(results_path, f'{repertoire_id}_ogrdb_plots.pdf'), 'wb') as plots:
+            plots.write(b'%PDF-1.4\n' + generator.randbytes(4096))
+
+        pre_processed_path = os.path.join(source_folder, 'pre_processed', subject, sample, run, 'metadata')
+        write_json(os.path.join(pre_processed_path, 'repertoire_id.json'),
+                   {'repertoire_id': repertoire_id, 'subject_id': subject, 'sample_id': sample})
+        write_json(os.path.join(pre_processed_path, 'pre_processed_metadata.json'),
+                   {'sample': {'data_processing': {'primary_annotation': True, 'data_processing_files': [f'{run}.fastq']}}})
+
+        metadata_repertoires.append({
+            'repertoire_id': f'{repertoire_id}_{chain}',
+            'subject': {'subject_id': subject},
+            'sample': [{'sample_id': sample}],
+            'data_processing': [{'data_processing_id': '', 'data_processing_files': []}]
+        })
+        correspondence_rows.append((f'{PROJECT_NAME}.json', f'{PROJECT_NUMBER}_I{index // subjects + 1}_S{index + 1}', repertoire_id))
+
+    metadata_filename = os.path.join(project_path, 'project_metadata', 'metadata.json')
+    write_json(metadata_filename, {'Repertoire': metadata_repertoires})
+
+    # Other projects of the same chain folder, as in the real correspondence file
+    for index in range(repertoires):
+        correspondence_rows.append((f'PRJOTHER{index % 10}.json', f'P{index % 10 + 2}_I1_S{index + 1}', f'other{index:08d}'))
+
+    os.makedirs(os.path.join(target_repo_path, 'samples', PROJECT_NUMBER), exist_ok=True)
+    write_text(os.path.join(target_repo_path, 'airr_correspondence.csv'),
+               'airr_file,vdjbase_name,airr_repertoire_id\n' + ''.join(f'{row[0]},{row[1]},{row[2]}\n' for row in correspondence_rows))
+
+    return PROJECT_NAME, source_folder, metadata_filename, target_repo_path
+
+# Times a call repeat times with its output silenced; setup runs untimed before each call
+def time_call(function, repeat, setup=None):
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            started = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - started)
+
+    return {'min': min(timings), 'median': statistics.median(timings), 'runs': timings}
+
+# Peak traced memory, in bytes, of a call with its output silenced
+def peak_memory(function):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        tracemalloc.start()
+        try:
+            function()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+
+def benchmark_scale(root, repertoires, repeat, chain='IGH'):
+    """
+    Time every stage of the pipeline on a freshly generated data store of the given size.
+
+    The airr_correspondence.csv cache is dropped before each run so every timing includes its
+    parse, and the samples folder is emptied before each copy so copies are never skipped. The
+    peak memory of scanning the source and building the repertoire mapping is measured once.
+    Returns the timings per stage and that peak in bytes.
+    """
+    project_name, source_folder, metadata_filename, target_repo_path = generate_data_store(root, repertoires, chain)
+    airr_correspondence_path = os.path.join(target_repo_path, 'airr_correspondence.csv')
+    samples_path = os.path.join(target_repo_path, 'samples', PROJECT_NUMBER)
+
+    def reset():
+        converter._correspondence_cache.clear()
+        converter._validation_cache.clear()
+        shutil.rmtree(samples_path, ignore_errors=True)
+        os.makedirs(samples_path)
+
+    manifest = converter.build_project_manifest(source_folder, chain)
+    repertoire_mapping = converter.derive_vdjbase_project_mapping(airr_correspondence_path, project_name)
+    vdjbase_project_name = f'{PROJECT_NUMBER}_{project_name}'
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        repertoire_index = converter.merge_metadata(metadata_filename, target_repo_path, manifest['annotated'], manifest['pre_processed'],
+                                                    vdjbase_project_name, repertoire_mapping, chain)
+
+    def scan():
+        converter._correspondence_cache.clear()
+        converter.build_project_manifest(source_folder, chain)
+        converter.derive_vdjbase_project_mapping(airr_correspondence_path, project_name)
+
+    timings = {
+        'find_project_tsv_files': time_call(lambda: converter.find_project_tsv_files(source_folder, chain), repeat),
+        'verify_annotations_exist': time_call(lambda: converter.verify_annotations_exist(manifest, airr_correspondence_path, project_name), repeat, reset),
+        'validate_result_files': time_call(lambda: converter.validate_result_files(manifest['annotated'], repertoire_mapping), repeat, reset),
+        'merge_metadata': time_call(lambda: converter.merge_metadata(metadata_filename, target_repo_path, manifest['annotated'], manifest['pre_processed'],
+                                                                      vdjbase_project_name, repertoire_mapping, chain), repeat),
+        'copy_required_files': time_call(lambda: converter.copy_required_files(repertoire_mapping, repertoire_index, target_repo_path), repeat, reset),
+        'main': time_call(lambda: converter.run_project(project_name, source_folder, metadata_filename, target_repo_path), repeat, reset)
+    }
+    return timings, peak_memory(scan)
+
+
+def benchmark_startup(repeat):
+    """
+    Time `python <entry point> --help` for every entry point: interpreter start-up plus every
+    module-level import. A heavy import added at module level (pandas alone takes about 0.4s)
+    pushes an entry point over STARTUP_BUDGET.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for entry_point in ENTRY_POINTS:
+        command = [sys.executable, os.path.join(directory, entry_point), '--help']
+        results[entry_point] = time_call(lambda: subprocess.run(command, stdout=subprocess.DEVNULL, check=True), repeat)
+        print(f"{entry_point:<34} start-up min {results[entry_point]['min']:.4f}s  median {results[entry_point]['median']:.4f}s"
+              f"  (budget {STARTUP_BUDGET}s)")
+
+    return results
+
+
+def check_validation(work_dir=None, chain='IGH'):
+    """
+    Check that validate_result_files rejects broken result files of a generated data store: an
+    empty Finale TSV (which sorts before the haplotype tables also named ..._Finale_...), a
+    genotype.tsv whose last row was cut off and a haplotype table with a ragged row. Returns the
+    names of the cases that were not rejected.
+    """
+    root = tempfile.mkdtemp(prefix='vdjbase_validation_', dir=work_dir)
+    try:
+        project_name, source_folder, _, target_repo_path = generate_data_store(root, 4, chain, rows=5)
+        manifest = converter.build_project_manifest(source_folder, chain)
+        repertoire_mapping = converter.derive_vdjbase_project_mapping(os.path.join(target_repo_path, 'airr_correspondence.csv'), project_name)
+        # (case, file the case breaks, how it is broken)
+        breakages = [
+            ('empty Finale TSV', lambda name: name.endswith('_Finale.tsv'), lambda text: ''),
+            ('truncated genotype.tsv', lambda name: name.endswith('genotype.tsv'), lambda text: text[:-3]),
+            ('ragged haplotype table', lambda name: 'haplotype' in name, lambda text: text + 'extra\tfields\n')
+        ]
+        missed = []
+        for (case, matches, breakage), run in zip(breakages, manifest['annotated']):
+            # Found on disk rather than through the run record, so a file the scan did not record is still broken
+            run_path = os.path.dirname(run.annotation_metadata_folder)
+            path = next(os.path.join(folder, name) for folder, _, names in os.walk(run_path) for name in sorted(names) if matches(name))
+            with open(path, 'r') as file:
+                text = file.read()
+            with open(path, 'w') as file:
+                file.write(breakage(text))
+
+            converter._validation_cache.clear()
+            try:
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    converter.validate_result_files(manifest['annotated'], repertoire_mapping)
+                missed.append(case)
+            except ValueError as e:
+                if path not in str(e):
+                    missed.append(case)
+
+            with open(path, 'w') as file:
+                file.write(text)
+
+        print(f"Validation check: {len(breakages) - len(missed)} of {len(breakages)} broken inputs rejected" + (f", missed: {', '.join(missed)}" if missed else ''))
+        return missed
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def run_benchmarks(scales, repeat, work_dir=None, chain='IGH'):
+    results = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'scales': {},
+        'scan_peak_memory_bytes': {},
+        'startup': benchmark_startup(repeat)
+    }
+    for repertoires in scales:
+        root = tempfile.mkdtemp(prefix=f'vdjbase_bench_{repertoires}_', dir=work_dir)
+        try:
+            results['scales'][str(repertoires)], results['scan_peak_memory_bytes'][str(repertoires)] = benchmark_scale(root, repertoires, repeat, chain)
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
+
+        for stage, timing in results['scales'][str(repertoires)].items():
+            print(f"{repertoires:>6} repertoires  {stage:<26} min {timing['min']:.4f}s  median {timing['median']:.4f}s")
+        print(f"{repertoires:>6} repertoires  {'scan peak memory':<26} {results['scan_peak_memory_bytes'][str(repertoires)] / 2**20:.1f} MB")
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the conversion pipeline on synthetic data stores.')
+
+    # Add arguments
+    parser.add_argument('--scales', type=int, nargs='+', default=[100, 1000], help='Numbers of repertoires to benchmark')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per stage')
+    parser.add_argument('--chain', type=str, default='IGH', help='Chain of the synthetic data store')
+    parser.add_argument('--work-dir', type=str, default=None, help='Folder for the generated data stores (default: system temp)')
+    parser.add_argument('--output', type=str, default=None, help='Write the results as JSON to this path')
+    parser.add_argument('--generate-only', type=str, default=None, help='Only generate a data store of the first scale in this folder')
+    parser.add_argument('--check-validation', action='store_true', help='Only check that broken result files are rejected; exit with status 1 when one is not')
+    parser.add_argument('--startup-only', action='store_true', help='Only time the start-up of the entry points; exit with status 1 when one is over budget')
+
+    # Parse the arguments
+    args = parser.parse_args()
+    if args.generate_only:
+        print(' '.join(generate_data_store(args.generate_only, args.scales[0], args.chain)))
+        sys.exit(0)
+
+    if args.check_validation:
+        sys.exit(1 if check_validation(args.work_dir, args.chain) else 0)
+
+    if args.startup_only:
+        startup = benchmark_startup(args.repeat)
+        sys.exit(1 if any(timing['min'] > STARTUP_BUDGET for timing in startup.values()) else 0)
+
+    benchmark_results = run_benchmarks(args.scales, args.repeat, args.work_dir, args.chain)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(benchmark_results, output, indent=4)
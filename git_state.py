@@ -0,0 +1,257 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import tempfile
+import subprocess
+
+# Seconds during which a fetch of the same repo is not repeated; FETCH_HEAD keeps the time of the last one, across processes
+FETCH_TTL = 300
+# Lock file, in the temp folder and named after the git directory, held while a fetch runs so parallel publishers
+# do not fetch at the same time. It is left in place: removing it would let a waiting process lock a file no one else sees
+FETCH_LOCK_NAME = 'vdjbase_fetch_{}.lock'
+# Symbolic refs are followed at most this deep, as git does
+MAX_SYMREF_DEPTH = 5
+
+
+# Finds the git directory of a work tree (its .git folder or the folder a .git file points to) or of a bare repo, and its common directory
+def find_git_dirs(repo_path):
+    git_dir = os.path.join(repo_path, '.git')
+    if os.path.isfile(git_dir):
+        with open(git_dir, 'r') as git_file:
+            content = git_file.read().strip()
+        if not content.startswith('gitdir:'):
+            raise ValueError(f"Unexpected content in {git_dir}")
+        git_dir = os.path.join(repo_path, content[len('gitdir:'):].strip())
+    elif not os.path.isdir(git_dir):
+        if not (os.path.isfile(os.path.join(repo_path, 'HEAD')) and os.path.isdir(os.path.join(repo_path, 'refs'))):
+            raise FileNotFoundError(f"Not a git repository: {repo_path}")
+        git_dir = repo_path
+
+    common_dir = git_dir
+    commondir_path = os.path.join(git_dir, 'commondir')
+    if os.path.isfile(commondir_path):
+        with open(commondir_path, 'r') as commondir_file:
+            common_dir = os.path.join(git_dir, commondir_file.read().strip())
+
+    return os.path.normpath(git_dir), os.path.normpath(common_dir)
+
+# Reads a git config file into {(section, subsection): {key: value}}; keys and section names are lower-cased as git compares them
+def read_config(config_path):
+    config = {}
+    section = None
+    if not os.path.isfile(config_path):
+        return config
+
+    with open(config_path, 'r') as config_file:
+        for line in config_file:
+            line = line.strip()
+            if not line or line[0] in '#;':
+                continue
+            if line.startswith('['):
+                header = line[1:line.index(']')].strip()
+                name, _, subsection = header.partition(' ')
+                section = (name.lower(), subsection.strip().strip('"') or None)
+                config.setdefault(section, {})
+                continue
+            if section is not None:
+                key, _, value = line.partition('=')
+                config[section][key.strip().lower()] = value.strip().strip('"') if value else 'true'
+
+    return config
+
+# Reads packed-refs into {ref name: sha}, skipping the peeled (^) lines of annotated tags
+def read_packed_refs(common_dir):
+    packed = {}
+    packed_refs_path = os.path.join(common_dir, 'packed-refs')
+    if os.path.isfile(packed_refs_path):
+        with open(packed_refs_path, 'r') as packed_refs_file:
+            for line in packed_refs_file:
+                if line.startswith(('#', '^')) or not line.strip():
+                    continue
+                sha, _, name = line.strip().partition(' ')
+                packed[name] = sha
+
+    return packed
+
+
+def resolve_ref(git_dir, common_dir, ref_name, packed=None):
+    """
+    Resolve a ref name (HEAD, refs/heads/main, refs/remotes/origin/main) to a commit sha by
+    reading the ref files directly: the loose ref file first, following symbolic refs, then
+    packed-refs. Per-worktree refs (HEAD) live in git_dir, shared ones in common_dir. Returns
+    None when the ref does not exist.
+    """
+    for _ in range(MAX_SYMREF_DEPTH):
+        ref_dir = git_dir if ref_name == 'HEAD' else common_dir
+        ref_path = os.path.join(ref_dir, *ref_name.split('/'))
+        if os.path.isfile(ref_path):
+            with open(ref_path, 'r') as ref_file:
+                content = ref_file.read().strip()
+            if content.startswith('ref:'):
+                ref_name = content[len('ref:'):].strip()
+                continue
+            return content
+
+        if packed is None:
+            packed = read_packed_refs(common_dir)
+        return packed.get(ref_name)
+
+    raise ValueError(f"Symbolic ref loop while resolving {ref_name} in {git_dir}")
+
+# Returns the full ref name HEAD points to, or None for a detached HEAD
+def head_branch(git_dir):
+    with open(os.path.join(git_dir, 'HEAD'), 'r') as head_file:
+        content = head_file.read().strip()
+
+    return content[len('ref:'):].strip() if content.startswith('ref:') else None
+
+# Maps a local branch to its upstream ref through branch.<name>.remote/merge and the remote's fetch refspec
+def upstream_ref(config, branch):
+    branch_config = config.get(('branch', branch[len('refs/heads/'):]), {})
+    remote = branch_config.get('remote')
+    merge = branch_config.get('merge')
+    if not remote or not merge:
+        return None, None
+    if remote == '.':
+        return remote, merge
+
+    fetch = config.get(('remote', remote), {}).get('fetch', f'+refs/heads/*:refs/remotes/{remote}/*')
+    source, _, destination = fetch.lstrip('+').partition(':')
+    if source.endswith('*') and destination.endswith('*') and merge.startswith(source[:-1]):
+        return remote, destination[:-1] + merge[len(source) - 1:]
+
+    return remote, f'refs/remotes/{remote}/{merge[len("refs/heads/"):]}'
+
+
+def read_repo_state(repo_path):
+    """
+    Return the branch, HEAD commit, upstream remote and ref and upstream commit of a repo.
+
+    Everything is read from the repo files, without running git. Repos whose refs are not stored
+    as files (the reftable format) fall back to a single `git rev-parse` run in repo_path.
+    """
+    git_dir, common_dir = find_git_dirs(repo_path)
+    config = read_config(os.path.join(common_dir, 'config'))
+    if config.get(('extensions', None), {}).get('refstorage', 'files') != 'files':
+        return read_repo_state_with_git(repo_path)
+
+    branch = head_branch(git_dir)
+    packed = read_packed_refs(common_dir)
+    state = {
+        'git_dir': git_dir,
+        'branch': branch,
+        'head': resolve_ref(git_dir, common_dir, 'HEAD', packed),
+        'remote': None,
+        'upstream_ref': None,
+        'upstream': None
+    }
+    if branch is not None:
+        state['remote'], state['upstream_ref'] = upstream_ref(config, branch)
+        if state['upstream_ref'] is not None:
+            state['upstream'] = resolve_ref(git_dir, common_dir, state['upstream_ref'], packed)
+
+    return state
+
+# Reads the same state with one git call, for repos read_repo_state cannot read directly
+def read_repo_state_with_git(repo_path):
+    # --symbolic-full-name applies to the names after it, so the commits come first
+    output = run_git(repo_path, ['rev-parse', '--absolute-git-dir', 'HEAD', '@{u}', '--symbolic-full-name', 'HEAD', '@{u}'])
+    git_dir, head, upstream, branch, upstream_ref_name = output.splitlines()
+    return {
+        'git_dir': git_dir,
+        'branch': branch if branch.startswith('refs/') else None,
+        'head': head,
+        'remote': upstream_ref_name.split('/')[2] if upstream_ref_name.startswith('refs/remotes/') else '.',
+        'upstream_ref': upstream_ref_name,
+        'upstream': upstream
+    }
+
+# Runs git with arguments (no shell) in repo_path and returns its output, raising RuntimeError with git's message on failure
+def run_git(repo_path, arguments):
+    result = subprocess.run(['git'] + arguments, cwd=repo_path, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"git {' '.join(arguments)} failed in {repo_path}: {result.stderr.strip()}")
+
+    return result.stdout.strip()
+
+
+def fetch(repo_path, remote, ttl=FETCH_TTL):
+    """
+    Fetch remote into repo_path unless the repo was fetched less than ttl seconds ago.
+
+    The time of the last fetch is the mtime of FETCH_HEAD, which git writes on every fetch, so
+    the TTL is shared by every process using the repo. Concurrent callers are serialised on a
+    lock file in the temp folder, so nothing is added to the repo; the ones that waited find a
+    fresh FETCH_HEAD and skip their fetch. Returns True when a fetch ran.
+    """
+    git_dir, common_dir = find_git_dirs(repo_path)
+    fetch_head_path = os.path.join(git_dir, 'FETCH_HEAD')
+
+    def fresh():
+        return os.path.isfile(fetch_head_path) and time.time() - os.path.getmtime(fetch_head_path) < ttl
+
+    if fresh():
+        return False
+
+    lock_name = FETCH_LOCK_NAME.format(hashlib.sha1(os.path.realpath(git_dir).encode()).hexdigest()[:16])
+    with open(os.path.join(tempfile.gettempdir(), lock_name), 'w') as lock_file:
+        try:
+            import fcntl
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        except ImportError:
+            pass
+
+        if fresh():
+            return False
+
+        run_git(repo_path, ['fetch', '--quiet', remote])
+        # git leaves FETCH_HEAD alone when nothing was fetched into it; the fetch still counts
+        if os.path.isfile(fetch_head_path):
+            os.utime(fetch_head_path)
+        else:
+            open(fetch_head_path, 'a').close()
+
+    return True
+
+
+def is_repo_up_to_date(repo_path, ttl=FETCH_TTL, fetch_remote=True):
+    """
+    Check that the current branch of repo_path points to the same commit as its upstream.
+
+    The upstream remote is fetched first (see fetch, at most once per ttl seconds). Raises
+    ValueError when HEAD is detached or the branch has no upstream.
+    """
+    state = read_repo_state(repo_path)
+    if state['branch'] is None:
+        raise ValueError(f"HEAD of {repo_path} is detached")
+    if state['upstream_ref'] is None:
+        raise ValueError(f"Branch {state['branch']} of {repo_path} has no upstream")
+
+    if fetch_remote and state['remote'] != '.':
+        if fetch(repo_path, state['remote'], ttl):
+            state = read_repo_state(repo_path)
+
+    return state['head'] is not None and state['head'] == state['upstream']
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Show the HEAD and upstream state of a git repository.')
+
+    # Add arguments
+    parser.add_argument('repo_path', type=str, help='Path to the repository')
+    parser.add_argument('--fetch', action='store_true', help='Fetch the upstream remote first')
+    parser.add_argument('--ttl', type=float, default=FETCH_TTL, help='Skip the fetch when the repo was fetched less than this many seconds ago')
+
+    # Parse the arguments
+    args = parser.parse_args()
+    repo_state = read_repo_state(args.repo_path)
+    if args.fetch and repo_state['remote'] not in (None, '.'):
+        fetch(args.repo_path, repo_state['remote'], args.ttl)
+        repo_state = read_repo_state(args.repo_path)
+
+    repo_state['up_to_date'] = repo_state['head'] is not None and repo_state['head'] == repo_state['upstream']
+    print(json.dumps(repo_state, indent=4))
+    sys.exit(0 if repo_state['up_to_date'] else 1)
@@ -1,42 +1,126 @@
 import os
-import shutil
+import re
+import sys
 import json
-import pandas as pd
+import glob
 import argparse
 
+# Chain suffix of a repertoire_id, e.g. 0a1b2c3d_IGH -> 0a1b2c3d; anchored so IDs that only contain a chain name are left alone
+CHAIN_SUFFIX = re.compile(r'_(?:IGH|IGK|IGL)$')
 
 
 def main(metadata_path, target_repo_path):
+    result = remove_chain_from_file(metadata_path)
+    if result['status'] == 'failed':
+        print(f"An error occurred: {result['error']}")
+    elif result['status'] == 'skipped':
+        print(f"An error occurred: {metadata_path} has no Repertoire list")
 
-    try:
-        parts = target_repo_path.split('/')
-        repo_path = '/'.join(parts[:-3])
-        chain = parts[-1]
+# Removes the chain suffix from every repertoire_id of a project metadata document, returning the number of IDs changed
+def remove_chain_suffix(project_metadata):
+    changed = 0
+    for repertoire in project_metadata["Repertoire"]:
+        original_id = repertoire['repertoire_id']
+        updated_id = CHAIN_SUFFIX.sub('', original_id)
+        if updated_id != original_id:
+            repertoire['repertoire_id'] = updated_id
+            changed += 1
+
+    return changed
+
+
+def remove_chain_from_file(metadata_path):
+    """
+    Remove the chain suffix from the repertoire IDs of one metadata file.
 
+    The file is rewritten, through a temp file renamed over it, only when an ID changed. Files
+    that are not project metadata (no Repertoire list) are skipped. Returns a result record
+    instead of raising, so it can run on a worker process of the bulk mode.
+    """
+    result = {'path': metadata_path, 'ids_changed': 0, 'status': 'unchanged'}
+    try:
         with open(metadata_path, 'r') as metadata_file:
             project_metadata = json.load(metadata_file)
-        
-        # Update repertoire_id by removing '_IGH', '_IGK', '_IGL'
-        for repertoire in project_metadata["Repertoire"]:
-            original_id = repertoire['repertoire_id']
-            updated_id = original_id.replace('_IGH', '').replace('_IGK', '').replace('_IGL', '')
-            repertoire['repertoire_id'] = updated_id
 
-        # Write the updated metadata directly to the original file
-        with open(metadata_path, 'w') as metadata_file:
-            json.dump(project_metadata, metadata_file, indent=4)
+        if not isinstance(project_metadata, dict) or not isinstance(project_metadata.get("Repertoire"), list):
+            result['status'] = 'skipped'
+            return result
+
+        result['ids_changed'] = remove_chain_suffix(project_metadata)
+        if result['ids_changed']:
+            temp_path = metadata_path + '.tmp'
+            with open(temp_path, 'w') as metadata_file:
+                json.dump(project_metadata, metadata_file, indent=4)
+            os.replace(temp_path, metadata_path)
+            result['status'] = 'rewritten'
 
     except Exception as e:
-        print(f"An error occurred: {e}")
+        result['status'] = 'failed'
+        result['error'] = f"{type(e).__name__}: {e}"
+
+    return result
+
+# Expands files, directories (searched recursively for .json files, hidden ones excluded) and globs into a sorted list of files
+def find_metadata_files(inputs):
+    files = set()
+    for path in inputs:
+        if os.path.isfile(path):
+            files.add(os.path.abspath(path))
+        elif os.path.isdir(path):
+            for root, folders, names in os.walk(path):
+                folders[:] = [folder for folder in folders if not folder.startswith('.')]
+                files.update(os.path.abspath(os.path.join(root, name)) for name in names if name.endswith('.json') and not name.startswith('.'))
+        else:
+            files.update(os.path.abspath(match) for match in glob.glob(path, recursive=True) if os.path.isfile(match))
+
+    return sorted(files)
+
+
+def remove_chain_bulk(inputs, workers=None):
+    """
+    Remove the chain suffix from the repertoire IDs of every metadata file under inputs.
+
+    Files are processed in parallel on a pool of worker processes, each reading, updating and
+    (when needed) atomically rewriting whole files. Prints a summary and returns it with one
+    result per file.
+    """
+    files = find_metadata_files(inputs)
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(files) < 2:
+        results = [remove_chain_from_file(path) for path in files]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(remove_chain_from_file, files, chunksize=max(1, len(files) // (workers * 4))))
+
+    summary = {status: sum(1 for result in results if result['status'] == status) for status in ('rewritten', 'unchanged', 'skipped', 'failed')}
+    summary['files'] = len(results)
+    summary['ids_changed'] = sum(result['ids_changed'] for result in results)
+    for result in results:
+        if result['status'] == 'failed':
+            print(f"Failed to update {result['path']}. Reason: {result['error']}")
+
+    print(f"{summary['files']} files: {summary['rewritten']} rewritten, {summary['unchanged']} unchanged, {summary['skipped']} skipped, "
+          f"{summary['failed']} failed; {summary['ids_changed']} repertoire IDs updated")
+    summary['results'] = results
+    return summary
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Process some inputs.')
 
     # Add arguments
-    parser.add_argument('metadata_filename', type=str, help='Path to the metadata file')
-    parser.add_argument('target_repo_path', type=str, help='Path to the target repository')
+    parser.add_argument('metadata_filename', type=str, nargs='?', help='Path to the metadata file')
+    parser.add_argument('target_repo_path', type=str, nargs='?', help='Path to the target repository')
+    parser.add_argument('--bulk', action='append', default=[], help='Metadata file, directory (searched recursively) or glob to process in bulk; repeatable')
+    parser.add_argument('--workers', type=int, default=None, help='Number of files processed in parallel in bulk mode (default: number of cores)')
 
     # Parse the arguments
     args = parser.parse_args()
-    main(args.metadata_filename, args.target_repo_path)
\ No newline at end of file
+    if args.bulk:
+        bulk_summary = remove_chain_bulk(args.bulk + ([args.metadata_filename] if args.metadata_filename else []), args.workers)
+        sys.exit(1 if bulk_summary['failed'] else 0)
+
+    if not args.metadata_filename or not args.target_repo_path:
+        parser.error('metadata_filename and target_repo_path are required without --bulk')
+    main(args.metadata_filename, args.target_repo_path)
@@ -0,0 +1,246 @@
+import os
+import copy
+import time
+import zlib
+import struct
+import zipfile
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+SAMPLES_ZIP_NAME = 'samples.zip'
+# Files above this size are compressed by zipfile in streaming mode instead of in memory on the worker threads
+IN_MEMORY_LIMIT = 64 * 1024 * 1024
+COMPRESS_LEVEL = 6
+# Header ID of the ZIP64 extended information extra field
+ZIP64_EXTRA_ID = 0x0001
+# Bit of flag_bits telling that CRC and sizes follow the data in a data descriptor
+DATA_DESCRIPTOR_FLAG = 0x08
+
+
+def update_samples_zip(target_repo_path, project_numbers, jobs=None, level=COMPRESS_LEVEL):
+    """
+    Update samples.zip for the samples/<project_number> folders that were just published.
+
+    Members outside those folders, and members inside them whose size and modification time did
+    not change, are copied into the new archive as already-compressed bytes. Only new or changed
+    files are compressed, on a pool of jobs threads (zlib releases the GIL). Members of deleted
+    files are dropped. The new archive is written next to the old one and renamed over it.
+    Returns counts of reused, compressed and removed members.
+    """
+    samples_zip_path = os.path.join(target_repo_path, SAMPLES_ZIP_NAME)
+    changed_prefixes = tuple(f'samples/{project_number}/' for project_number in project_numbers)
+    current_files, current_dirs = list_subtree_files(target_repo_path, project_numbers)
+    stats = {'reused': 0, 'compressed': 0, 'linked': 0, 'removed': 0}
+
+    temp_path = samples_zip_path + '.tmp'
+    old_zip = zipfile.ZipFile(samples_zip_path) if os.path.isfile(samples_zip_path) else None
+    try:
+        with zipfile.ZipFile(temp_path, 'w', allowZip64=True) as new_zip:
+            if old_zip is not None:
+                for info in old_zip.infolist():
+                    if not info.filename.startswith(changed_prefixes):
+                        copy_raw_member(old_zip, info, new_zip)
+                        stats['reused'] += 1
+                    elif info.is_dir():
+                        continue
+                    elif info.filename not in current_files:
+                        stats['removed'] += 1
+                    elif member_is_current(info, current_files[info.filename]):
+                        copy_raw_member(old_zip, info, new_zip)
+                        stats['reused'] += 1
+                        del current_files[info.filename]
+
+            for arcname in current_dirs:
+                write_directory_member(new_zip, arcname)
+
+            stats['compressed'], stats['linked'] = compress_members(new_zip, sorted(current_files.items()), jobs, level)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+    finally:
+        if old_zip is not None:
+            old_zip.close()
+
+    os.replace(temp_path, samples_zip_path)
+    print(f"{SAMPLES_ZIP_NAME} updated: {stats['reused']} members reused, {stats['compressed']} compressed, "
+          f"{stats['linked']} copied from a hard link already compressed, {stats['removed']} removed")
+    return stats
+
+# Lists the files (arcname -> path) and folders of the samples/<project_number> subtrees, skipping hidden sidecar files
+def list_subtree_files(target_repo_path, project_numbers):
+    files = {}
+    dirs = []
+    for project_number in project_numbers:
+        project_dir = os.path.join(target_repo_path, 'samples', project_number)
+        for root, folders, names in os.walk(project_dir):
+            folders.sort()
+            dirs.append(os.path.relpath(root, target_repo_path).replace(os.sep, '/') + '/')
+            for name in names:
+                if not name.startswith('.'):
+                    path = os.path.join(root, name)
+                    files[os.path.relpath(path, target_repo_path).replace(os.sep, '/')] = path
+
+    return files, dirs
+
+# Checks that a member was written from a file with the same size and (two-second) DOS modification time
+def member_is_current(info, path):
+    file_stat = os.stat(path)
+    date_time = time.localtime(file_stat.st_mtime)[:6]
+    date_time = date_time[:5] + (date_time[5] - date_time[5] % 2,)
+    return info.file_size == file_stat.st_size and info.date_time == date_time
+
+# Removes the ZIP64 field from an extra block so FileHeader can write a fresh one
+def strip_zip64_extra(extra):
+    stripped = b''
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, size = struct.unpack('<HH', extra[offset:offset + 4])
+        if header_id != ZIP64_EXTRA_ID:
+            stripped += extra[offset:offset + 4 + size]
+        offset += 4 + size
+
+    return stripped
+
+# Appends a member whose compressed bytes are already known: writes its local header and data and registers it for the central directory
+def append_member(new_zip, info, write_data):
+    info.header_offset = new_zip.fp.tell()
+    new_zip.fp.write(info.FileHeader(zip64=info.file_size > zipfile.ZIP64_LIMIT or info.compress_size > zipfile.ZIP64_LIMIT))
+    write_data(new_zip.fp)
+    new_zip.filelist.append(info)
+    new_zip.NameToInfo[info.filename] = info
+    new_zip.start_dir = new_zip.fp.tell()
+    new_zip._didModify = True
+
+# Copies a member of the old archive without decompressing it
+def copy_raw_member(old_zip, info, new_zip):
+    old_zip.fp.seek(info.header_offset)
+    local_header = old_zip.fp.read(zipfile.sizeFileHeader)
+    name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+    old_zip.fp.seek(info.header_offset + zipfile.sizeFileHeader + name_length + extra_length)
+
+    new_info = copy.copy(info)
+    new_info.extra = strip_zip64_extra(info.extra)
+    # CRC and sizes are known, so they go in the local header instead of a data descriptor
+    new_info.flag_bits &= ~DATA_DESCRIPTOR_FLAG
+
+    def write_data(destination):
+        remaining = info.compress_size
+        while remaining > 0:
+            chunk = old_zip.fp.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                raise EOFError(f"Truncated member {info.filename} in {old_zip.filename}")
+            destination.write(chunk)
+            remaining -= len(chunk)
+
+    append_member(new_zip, new_info, write_data)
+
+
+def write_directory_member(new_zip, arcname):
+    info = zipfile.ZipInfo(arcname, time.localtime()[:6])
+    info.external_attr = (0o40775 << 16) | 0x10
+    info.compress_type = zipfile.ZIP_STORED
+    info.CRC = 0
+    append_member(new_zip, info, lambda destination: None)
+
+# Appends a member holding the same compressed data as a member already written to new_zip, for another hard link to the same file
+def copy_written_member(new_zip, written_info, arcname):
+    end = new_zip.fp.tell()
+    new_zip.fp.seek(written_info.header_offset)
+    local_header = new_zip.fp.read(zipfile.sizeFileHeader)
+    name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+    new_zip.fp.seek(written_info.header_offset + zipfile.sizeFileHeader + name_length + extra_length)
+    compressed = new_zip.fp.read(written_info.compress_size)
+    new_zip.fp.seek(end)
+
+    info = copy.copy(written_info)
+    info.filename = info.orig_filename = arcname
+    info.extra = strip_zip64_extra(written_info.extra)
+    append_member(new_zip, info, lambda destination: destination.write(compressed))
+
+# Deflates one file in memory on a worker thread
+def compress_file(path, arcname, level):
+    info = zipfile.ZipInfo.from_file(path, arcname)
+    with open(path, 'rb') as file:
+        data = file.read()
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.CRC = zlib.crc32(data)
+    info.file_size = len(data)
+    info.compress_size = len(compressed)
+    return info, compressed
+
+
+def compress_members(new_zip, files, jobs, level):
+    """
+    Compress files, a list of (arcname, path), into new_zip in order.
+
+    Small files are deflated in parallel in batches: the next batch is compressed while the current
+    one is written, so at most two batches of compressed data are held in memory. Files larger than
+    IN_MEMORY_LIMIT are streamed through zipfile on the calling thread. Files that are hard links to
+    one another (the object store of Annotation_to_VDJbase --dedup) are deflated once; the other
+    links copy the compressed data of the first. Returns the number of files deflated and the
+    number copied that way.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    batch_size = jobs * 4
+    batches = [files[start:start + batch_size] for start in range(0, len(files), batch_size)]
+    # (st_dev, st_ino) of the hard-linked files already submitted, and the member written for each
+    scheduled = set()
+    linked_members = {}
+    linked = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+
+        # Submits the small files of a batch; returns (link key, future) per file, future None for streamed files and further links
+        def schedule(batch):
+            tasks = []
+            for arcname, path in batch:
+                file_stat = os.stat(path)
+                link_key = (file_stat.st_dev, file_stat.st_ino) if file_stat.st_nlink > 1 else None
+                if file_stat.st_size > IN_MEMORY_LIMIT:
+                    tasks.append((None, None))
+                elif link_key is not None and link_key in scheduled:
+                    tasks.append((link_key, None))
+                else:
+                    if link_key is not None:
+                        scheduled.add(link_key)
+                    tasks.append((link_key, executor.submit(compress_file, path, arcname, level)))
+
+            return tasks
+
+        next_tasks = schedule(batches[0]) if batches else None
+        for position, batch in enumerate(batches):
+            tasks = next_tasks
+            next_tasks = schedule(batches[position + 1]) if position + 1 < len(batches) else None
+            for (arcname, path), (link_key, future) in zip(batch, tasks):
+                if future is None and link_key is None:
+                    new_zip.write(path, arcname, compress_type=zipfile.ZIP_DEFLATED, compresslevel=level)
+                    continue
+
+                # Links are written in file order, so the first link of a file is written before the others
+                if future is None:
+                    copy_written_member(new_zip, linked_members[link_key], arcname)
+                    linked += 1
+                    continue
+
+                info, compressed = future.result()
+                append_member(new_zip, info, lambda destination: destination.write(compressed))
+                if link_key is not None:
+                    linked_members[link_key] = info
+
+    return len(files) - linked, linked
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Update samples.zip of a VDJbase chain folder for the given project numbers.')
+
+    # Add arguments
+    parser.add_argument('target_repo_path', type=str, help='Path to the target repository chain folder')
+    parser.add_argument('project_numbers', type=str, nargs='+', help='Project numbers (samples/<project_number>) that changed')
+    parser.add_argument('--jobs', type=int, default=None, help='Number of compression threads (default: number of cores)')
+    parser.add_argument('--level', type=int, default=COMPRESS_LEVEL, help='Deflate compression level')
+
+    # Parse the arguments
+    args = parser.parse_args()
+    update_samples_zip(args.target_repo_path, args.project_numbers, args.jobs, args.level)
@@ -0,0 +1,257 @@
+import os
+import sys
+import time
+import argparse
+import datetime
+
+import samples_zip
+import Annotation_to_VDJbase as converter
+
+# Result files a run needs, besides its Finale TSV and metadata, before it is published; haplotype tables are only made for some samples
+WATCH_REQUIRED_FILES = ['genotype.tsv', 'ogrdb_plots.pdf', 'ogrdb_report.csv']
+
+
+def new_watch_state():
+    return {
+        'mtime_index': {},  # directory -> (mtime_ns, sub-folders), see list_folders
+        'published': {},    # run folder -> fingerprint when it was published
+        'pending': {},      # run folder -> (signature, time it was first seen with that signature)
+        'ready': {},        # run folder -> fingerprint, complete and settled, waiting for the next batch
+        'broken': {},       # run folder -> signature when it was left out of a batch for a broken result file
+        'first_ready': None,
+        'last_ready': None
+    }
+
+# Lists the sub-folders of a directory, relisting it only when its mtime changed since the last poll
+def list_folders(path, mtime_index):
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+        cached = mtime_index.get(path)
+        if cached is not None and cached[0] == mtime_ns:
+            return cached[1]
+
+        with os.scandir(path) as entries:
+            folders = sorted(entry.path for entry in entries if entry.is_dir())
+    except FileNotFoundError:
+        mtime_index.pop(path, None)
+        return []
+
+    mtime_index[path] = (mtime_ns, folders)
+    return folders
+
+# Finds the {chain}_annotated/<subject>/<sample>/<run> folders
+def find_runs(annotated_path, mtime_index):
+    runs = []
+    for subject in list_folders(annotated_path, mtime_index):
+        for sample in list_folders(subject, mtime_index):
+            runs.extend(list_folders(sample, mtime_index))
+
+    return runs
+
+# The mtimes of a run folder and its sub-folders; they change whenever a result file is added, removed or renamed
+def run_fingerprint(run_path, mtime_index):
+    try:
+        return tuple(os.stat(path).st_mtime_ns for path in [run_path] + list_folders(run_path, mtime_index))
+    except FileNotFoundError:
+        return None
+
+# Name, size and mtime of every file in the sub-folders of a run; it stops changing once the pipeline finished writing the run
+def run_signature(run_path, mtime_index):
+    signature = []
+    for folder in list_folders(run_path, mtime_index):
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        file_stat = entry.stat()
+                        signature.append((os.path.basename(folder), entry.name, file_stat.st_size, file_stat.st_mtime_ns))
+        except FileNotFoundError:
+            continue
+
+    return tuple(sorted(signature))
+
+# Checks that a run has the files find_tsv_and_metadata_for_annotated needs and the required result files
+def run_is_complete(signature):
+    file_names = [name for _, name, _, _ in signature]
+    return (any('Finale' in name for name in file_names)
+            and 'repertoire_id.json' in file_names
+            and 'annotation_metadata.json' in file_names
+            and all(any(required_file in name for name in file_names) for required_file in WATCH_REQUIRED_FILES))
+
+
+def poll_runs(annotated_path, state, settle, now):
+    """
+    Look for runs that are new or changed since they were published, and move the ones that are
+    complete and did not change for settle seconds to the ready set.
+
+    Published runs cost a few stats per poll (run_fingerprint); only new or changed runs have
+    their files listed. A ready run that changes again goes back to settling. Returns the number
+    of runs that became ready.
+    """
+    newly_ready = 0
+    runs = find_runs(annotated_path, state['mtime_index'])
+    for run in runs:
+        fingerprint = run_fingerprint(run, state['mtime_index'])
+        if fingerprint is None or state['published'].get(run) == fingerprint or state['ready'].get(run) == fingerprint:
+            continue
+
+        state['ready'].pop(run, None)
+        signature = run_signature(run, state['mtime_index'])
+        # A run left out for a broken result file waits until its files change
+        if state['broken'].get(run) == signature:
+            continue
+        state['broken'].pop(run, None)
+        previous = state['pending'].get(run)
+        if previous is None or previous[0] != signature:
+            state['pending'][run] = (signature, now)
+            previous = state['pending'][run]
+
+        if run_is_complete(signature) and now - previous[1] >= settle:
+            del state['pending'][run]
+            state['ready'][run] = fingerprint
+            newly_ready += 1
+
+    # Forget runs that were deleted
+    existing = set(runs)
+    for runs_state in (state['published'], state['pending'], state['ready'], state['broken']):
+        for run in [run for run in runs_state if run not in existing]:
+            del runs_state[run]
+
+    if newly_ready:
+        state['last_ready'] = now
+        if state['first_ready'] is None:
+            state['first_ready'] = now
+
+    return newly_ready
+
+# A batch is published once no run became ready for debounce seconds, or once its oldest run waited max_wait seconds
+def batch_is_due(state, debounce, max_wait, now):
+    if not state['ready']:
+        return False
+
+    return now - state['last_ready'] >= debounce or now - state['first_ready'] >= max_wait
+
+
+def publish_batch(state, project_name, source_folder, metadata_filename, target_repo_path, publish_options, update_zip=False):
+    """
+    Publish the ready runs with an incremental, partial run of the whole project.
+
+    The run is restricted to the ready and already published runs, so runs that are still being
+    written are left out even when they already look complete to the converter. The incremental
+    sync, merge and scan cache skip everything that did not change, so only the files and metadata
+    of the new runs are copied and merged, and repertoires that are not annotated yet or have a
+    broken result file are left out instead of failing the run. Runs left out
+    for a broken file are retried once their files change. On failure the runs stay ready and are
+    retried with the next batch.
+    """
+    batch = dict(state['ready'])
+    print(f"{datetime.datetime.now().isoformat(timespec='seconds')} Publishing {len(batch)} new or changed runs:")
+    for run in sorted(batch):
+        print(f"  {os.path.relpath(run, source_folder)}")
+
+    started = time.time()
+    converter.reset_run_stats()
+    try:
+        project_number = converter.run_project(project_name, source_folder, metadata_filename, target_repo_path, partial=True,
+                                               run_folders=set(state['published']) | set(batch), **publish_options)
+        if update_zip:
+            samples_zip.update_samples_zip(target_repo_path, [project_number])
+    except Exception as e:
+        print(f"Publishing failed, the runs will be retried with the next batch. Reason: {e}")
+        state['first_ready'] = state['last_ready'] = time.monotonic()
+        return False
+
+    # Runs left out for a broken result file are retried once their files change
+    run_stats = converter.get_run_stats()
+    broken_runs = {run for run in batch for broken_file in run_stats['broken_files'] if broken_file['path'].startswith(run + os.sep)}
+    for run in batch:
+        del state['ready'][run]
+        if run in broken_runs:
+            state['broken'][run] = run_signature(run, state['mtime_index'])
+        else:
+            state['published'][run] = batch[run]
+    state['first_ready'] = state['last_ready'] = None
+    counters = run_stats['counters']
+    print(f"Published {len(batch) - len(broken_runs)} runs in {time.time() - started:.1f}s "
+          f"({counters.get('files_placed', 0)} files placed, {counters.get('repertoires_merged', 0)} repertoires merged)")
+    return True
+
+
+def watch(project_name, source_folder, metadata_filename, target_repo_path, interval=30, settle=60, debounce=120, max_wait=900, publish_options=None,
+          update_zip=False, once=False):
+    """
+    Watch source_folder and publish annotated runs into the target repo as the pipeline completes them.
+
+    The annotated tree is polled every interval seconds through an index of directory mtimes, so
+    an idle poll costs one stat per folder. Polling is used rather than inotify because the
+    sequence data store is usually on a network filesystem where inotify does not see writes made
+    by the compute nodes. A run is published once it is complete and its files did not change for
+    settle seconds; runs completed in a burst are published together (see batch_is_due). With
+    once, a single poll publishes every complete run without waiting, then returns whether it succeeded.
+    """
+    publish_options = dict(publish_options or {})
+    publish_options['incremental'] = publish_options.get('incremental') or 'mtime'
+    chain = os.path.basename(target_repo_path.rstrip('/'))
+    annotated_path = os.path.join(source_folder, f'{chain}_annotated')
+    converter.verify_directory_exists(annotated_path)
+    converter.verify_directory_exists(target_repo_path)
+
+    state = new_watch_state()
+    print(f"Watching {annotated_path} every {interval}s")
+    try:
+        while True:
+            now = time.monotonic()
+            poll_runs(annotated_path, state, 0 if once else settle, now)
+            if once:
+                if state['ready']:
+                    return publish_batch(state, project_name, source_folder, metadata_filename, target_repo_path, publish_options, update_zip)
+                print("No new complete runs")
+                return True
+
+            if batch_is_due(state, debounce, max_wait, now):
+                publish_batch(state, project_name, source_folder, metadata_filename, target_repo_path, publish_options, update_zip)
+
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print(f"Stopped watching, {len(state['ready'])} ready and {len(state['pending'])} settling runs were not published")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Watch a project source folder and publish newly annotated runs into the VDJbase repository.')
+
+    # Add arguments
+    parser.add_argument('project_name', type=str, help='Name of the project')
+    parser.add_argument('source_folder', type=str, help='Path to the source folder')
+    parser.add_argument('metadata_filename', type=str, help='Path to the metadata file')
+    parser.add_argument('target_repo_path', type=str, help='Path to the target repository')
+    parser.add_argument('--interval', type=float, default=30, help='Seconds between polls of the source folder')
+    parser.add_argument('--settle', type=float, default=60, help='Seconds a complete run must stay unchanged before it is published')
+    parser.add_argument('--debounce', type=float, default=120, help='Publish once no run became ready for this many seconds')
+    parser.add_argument('--max-wait', type=float, default=900, help='Publish at the latest this many seconds after the first run of a batch became ready')
+    parser.add_argument('--once', action='store_true', help='Publish the complete runs found by a single poll and exit')
+    parser.add_argument('--jobs', type=int, default=1, help='Number of files to copy in parallel')
+    parser.add_argument('--link-mode', choices=converter.LINK_MODES, default='copy', help='How files are placed in the target repository')
+    parser.add_argument('--incremental', choices=['mtime', 'hash'], default='mtime', help='How the incremental sync detects changed files')
+    parser.add_argument('--scan-workers', type=int, default=1, help='Number of directories listed concurrently while scanning the source folder')
+    parser.add_argument('--empty-to-null', action='store_true', help='Write empty strings of the merged project metadata as null')
+    parser.add_argument('--json-backend', choices=converter.JSON_BACKENDS, default='json', help='Encoder of the merged project metadata JSON')
+    parser.add_argument('--dedup', action='store_true', help=f'Store each distinct file once in {converter.OBJECT_STORE_NAME} of the target and place links to it')
+    parser.add_argument('--no-validate', action='store_true', help='Publish without checking the headers, rows and completeness of the TSV result files')
+    parser.add_argument('--update-samples-zip', action='store_true', help='Update samples.zip after every published batch')
+
+    # Parse the arguments
+    args = parser.parse_args()
+    options = {
+        'jobs': args.jobs,
+        'link_mode': args.link_mode,
+        'incremental': args.incremental,
+        'scan_workers': args.scan_workers,
+        'empty_to_null': args.empty_to_null,
+        'json_backend': args.json_backend,
+        'dedup': args.dedup,
+        'validate': not args.no_validate
+    }
+    published = watch(args.project_name, args.source_folder, args.metadata_filename, args.target_repo_path, args.interval, args.settle, args.debounce, args.max_wait, options,
+                      args.update_samples_zip, args.once)
+    if args.once and not published:
+        sys.exit(1)